@@ -0,0 +1,61 @@
+"""Resident memory of closed games, with and without GuessTable compaction.
+
+Run with `poetry run python benchmarks/memory.py`.
+"""
+
+import random
+import tracemalloc
+
+from geobot import geoguesser
+
+IMAGES = 2000
+GUESSES_PER_IMAGE = 15
+
+
+def build_images(freeze: bool) -> list[geoguesser.ImageGame]:
+    rng = random.Random(0)
+    images = []
+    for i in range(IMAGES):
+        image = geoguesser.ImageGame(
+            rng.uniform(-90, 90),
+            rng.uniform(-180, 180),
+            f"tag{i}",
+            f"tag{i}.png",
+            [geoguesser.MessageID(channel_id=rng.getrandbits(60), message_id=i)],
+            [geoguesser.MessageID(channel_id=rng.getrandbits(60), message_id=i)],
+        )
+        for user in range(GUESSES_PER_IMAGE):
+            image.guesses[rng.getrandbits(60)] = geoguesser.Guess(
+                rng.uniform(-90, 90),
+                rng.uniform(-180, 180),
+                geoguesser.MessageID(
+                    channel_id=rng.getrandbits(60), message_id=rng.getrandbits(60)
+                ),
+            )
+        if freeze:
+            image.freeze()
+        images.append(image)
+    return images
+
+
+def measure(freeze: bool) -> int:
+    tracemalloc.start()
+    images = build_images(freeze)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del images
+    return size
+
+
+def main():
+    guesses = IMAGES * GUESSES_PER_IMAGE
+    loose = measure(freeze=False)
+    frozen = measure(freeze=True)
+    print(f"{IMAGES} closed images, {guesses} guesses")
+    print(f"Guess objects: {loose / 1024:8.0f} KiB ({loose / guesses:.0f} B/guess)")
+    print(f"GuessTable:    {frozen / 1024:8.0f} KiB ({frozen / guesses:.0f} B/guess)")
+    print(f"Reduction:     {100 * (1 - frozen / loose):.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+from discord.ext import commands
+import asyncio
+import json
+import pathlib
+import time
+import typing
+import os
+
+from . import error
+
+PARENT_PATH = pathlib.Path(__file__).parent
+DATA_PATH = pathlib.Path(PARENT_PATH, "data")
+LIMITS_PATH = pathlib.Path(DATA_PATH, "limits.json")
+
+# Commands running at once, and commands allowed to wait for a free slot
+MAX_ACTIVE = 4
+MAX_WAITING = 32
+
+# Idle buckets are dropped once there are more than this many
+MAX_BUCKETS = 10000
+
+
+# Allows `burst` commands at once, refilling at `rate` commands per second
+class Limit:
+    rate: float
+    burst: float
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+
+    def as_ser(self) -> dict:
+        return {"rate": self.rate, "burst": self.burst}
+
+    @classmethod
+    def from_ser(cls, ser: dict) -> typing.Self:
+        return cls(ser["rate"], ser["burst"])
+
+
+# Per-user and per-channel limits of a command. None means unlimited
+class CommandLimits:
+    user: typing.Optional[Limit]
+    channel: typing.Optional[Limit]
+
+    def __init__(
+        self,
+        user: typing.Optional[Limit] = None,
+        channel: typing.Optional[Limit] = None,
+    ):
+        self.user = user
+        self.channel = channel
+
+    @classmethod
+    def from_ser(cls, ser: dict) -> typing.Self:
+        return cls(
+            user=Limit.from_ser(ser["user"]) if ser.get("user") else None,
+            channel=Limit.from_ser(ser["channel"]) if ser.get("channel") else None,
+        )
+
+
+DEFAULT_LIMITS = CommandLimits(user=Limit(0.5, 5), channel=Limit(2, 20))
+
+# Keyed by qualified command name (e.g. "geo guess"). Overridden by limits.json
+COMMAND_LIMITS: dict[str, CommandLimits] = {
+    "geo guess": CommandLimits(user=Limit(0.2, 3), channel=Limit(1, 10)),
+    "geo scores": CommandLimits(user=Limit(0.05, 2), channel=Limit(0.1, 3)),
+    "geo ping": CommandLimits(user=Limit(1, 5)),
+}
+
+
+class TokenBucket:
+    limit: Limit
+    tokens: float
+    updated: float
+
+    # Whether the user has been told to slow down since the bucket last had a token
+    notified: bool
+
+    def __init__(self, limit: Limit, now: float):
+        self.limit = limit
+        self.tokens = limit.burst
+        self.updated = now
+        self.notified = False
+
+    def refill(self, now: float):
+        self.tokens = min(
+            self.limit.burst, self.tokens + (now - self.updated) * self.limit.rate
+        )
+        self.updated = now
+
+    # Take a token. Returns 0 on success, or seconds until a token is available
+    def take(self, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.notified = False
+            return 0
+        return (1 - self.tokens) / self.limit.rate
+
+    def full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.limit.burst
+
+
+# Rate limits commands and bounds how many run or wait at once
+class Admission:
+    limits: dict[str, CommandLimits]
+    default: CommandLimits
+
+    # Keyed by (command, "user"/"channel", ID)
+    buckets: dict[tuple[str, str, int], TokenBucket]
+
+    max_active: int
+    max_waiting: int
+    waiting: int
+
+    # Maps command names to counts of rejections by reason
+    rejections: dict[str, dict[str, int]]
+
+    _slots: asyncio.Semaphore
+    # IDs of contexts holding a slot
+    _held: set[int]
+
+    def __init__(
+        self,
+        limits: typing.Optional[dict[str, CommandLimits]] = None,
+        default: CommandLimits = DEFAULT_LIMITS,
+        max_active: int = MAX_ACTIVE,
+        max_waiting: int = MAX_WAITING,
+        limits_file: typing.Optional[os.PathLike] = None,
+    ):
+        self.limits = dict(COMMAND_LIMITS if limits is None else limits)
+        self.default = default
+        self.buckets = {}
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.rejections = {}
+        self._slots = asyncio.Semaphore(max_active)
+        self._held = set()
+
+        try:
+            self.load(LIMITS_PATH if limits_file is None else limits_file)
+        except FileNotFoundError:
+            pass
+
+    # limits.json maps command names (or "default") to {"user": {"rate", "burst"},
+    # "channel": {...}}
+    def load(self, path: os.PathLike):
+        with open(path) as f:
+            data: dict = json.load(f)
+            for name, ser in data.items():
+                if name == "default":
+                    self.default = CommandLimits.from_ser(ser)
+                else:
+                    self.limits[name] = CommandLimits.from_ser(ser)
+
+    def reject(self, command: str, reason: str):
+        counts = self.rejections.setdefault(command, {})
+        counts[reason] = counts.get(reason, 0) + 1
+
+    def _bucket(
+        self, command: str, kind: str, id: int, limit: Limit, now: float
+    ) -> TokenBucket:
+        key = (command, kind, id)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self.buckets = {
+                    k: b for k, b in self.buckets.items() if not b.full(now)
+                }
+            bucket = TokenBucket(limit, now)
+            self.buckets[key] = bucket
+        return bucket
+
+    # Global check run before every command. Groups are skipped so that only
+    # the subcommand actually run is counted.
+    async def check(self, ctx: commands.Context) -> bool:
+        if ctx.command is None or isinstance(ctx.command, commands.Group):
+            return True
+        command = ctx.command.qualified_name
+        limits = self.limits.get(command, self.default)
+        now = time.monotonic()
+
+        for kind, id, limit in [
+            ("user", ctx.author.id, limits.user),
+            ("channel", ctx.channel.id, limits.channel),
+        ]:
+            if limit is None:
+                continue
+            bucket = self._bucket(command, kind, id, limit, now)
+            retry_after = bucket.take(now)
+            if retry_after > 0:
+                self.reject(command, kind)
+                notify = not bucket.notified
+                bucket.notified = True
+                raise error.RateLimited(command, kind, retry_after, notify)
+        return True
+
+    # Wait for a free slot, or refuse if too many commands are already waiting
+    async def before_invoke(self, ctx: commands.Context):
+        if ctx.command is None or isinstance(ctx.command, commands.Group):
+            return
+        if self._slots.locked() and self.waiting >= self.max_waiting:
+            self.reject(ctx.command.qualified_name, "queue")
+            raise error.Overloaded(ctx.command.qualified_name)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self._held.add(id(ctx))
+
+    # Free the context's slot, if it holds one. Called after every command and
+    # from the error handler, since slash commands that fail skip after hooks.
+    async def release(self, ctx: commands.Context):
+        if id(ctx) in self._held:
+            self._held.remove(id(ctx))
+            self._slots.release()
+
+    def install(self, bot: commands.Bot):
+        bot.add_check(self.check)
+        bot.before_invoke(self.before_invoke)
+        bot.after_invoke(self.release)
@@ -2,33 +2,81 @@ import discord
 from discord.ext import commands
 import pathlib
 import aiohttp
-import io
 import typing
 import logging
+import sys
+import os
 
 from . import geoguesser
+from . import engine
+from . import admission
+from . import watchdog
+from . import replication
+from . import lockfile
 from . import error
 
+# Opened on the first record, so importing this module doesn't create the file
 discord_handler = logging.FileHandler(
-    filename="discord.log", encoding="utf-8", mode="a"
+    filename="discord.log", encoding="utf-8", mode="a", delay=True
 )
 
 TOKEN_PATH = pathlib.Path(pathlib.Path(__file__).parent, "token")
 
 
-def start():
+# Reply with content of any length, continuing in follow-up messages
+async def reply_long(ctx: commands.Context, content: str):
+    parts = geoguesser.split_message(content)
+    await ctx.reply(parts[0])
+    for part in parts[1:]:
+        await ctx.send(part)
+
+
+# Runs with a given game state instead of loading one, e.g. when a standby takes
+# over, in which case `active` is the active lock it already holds
+def start(
+    state: typing.Optional[geoguesser.Geoguesser] = None,
+    active: typing.Optional[lockfile.LockFile] = None,
+):
+    # Only one process may own the game state. With an engine process, that
+    # process takes the lock instead
+    process_engine = state is None and os.environ.get("GEOBOT_ENGINE") == "process"
+    if active is None and not process_engine:
+        active = lockfile.LockFile(replication.ACTIVE_LOCK_PATH)
+        if not active.acquire():
+            # Only a primary that replicates ever hands over to a standby
+            if not os.environ.get("GEOBOT_REPLICATE"):
+                sys.exit(str(error.AlreadyRunning(str(active.path), active.holder())))
+            error.logger.warning(
+                f"Another geobot (PID {active.holder()}) is active, running as its standby"
+            )
+            replication.run_standby()
+            return
+
     intents = discord.Intents.default()
     intents.message_content = True
     intents.members = True
 
     bot = commands.Bot(command_prefix="/", intents=intents)
 
-    GEO: geoguesser.Geoguesser = geoguesser.Geoguesser(bot)
+    # Set GEOBOT_ENGINE=process to run the game engine in its own process
+    GEO: engine.Engine
+    if state is not None:
+        state.attach(bot)
+        GEO = engine.Engine(state)
+    elif process_engine:
+        GEO = engine.RemoteEngine(bot)  # type: ignore[assignment]
+    else:
+        GEO = engine.Engine(geoguesser.Geoguesser(bot))
+
+    ADMISSION = admission.Admission()
+    ADMISSION.install(bot)
+
+    WATCHDOG = watchdog.Watchdog()
 
     # Check for only subscribed channels
     def subscriber_only():
         async def predicate(ctx: commands.Context):
-            if ctx.channel.id not in GEO.subscribed:
+            if not await GEO.is_subscribed(ctx.channel.id):
                 raise error.SubscriberOnly()
             return True
 
@@ -37,14 +85,16 @@ def start():
     # Check for only channels with admin privileges
     def admin_only():
         async def predicate(ctx: commands.Context):
-            return ctx.channel.id in GEO.admins
+            return await GEO.is_admin(ctx.channel.id)
 
         return commands.check(predicate)
 
     # Check for either subscribers or admin
     def subscriber_admin_only():
         async def predicate(ctx: commands.Context):
-            return ctx.channel.id in GEO.admins or ctx.channel.id in GEO.subscribed
+            return await GEO.is_admin(ctx.channel.id) or await GEO.is_subscribed(
+                ctx.channel.id
+            )
 
         return commands.check(predicate)
 
@@ -68,18 +118,17 @@ def start():
 
     @geo.command(name="subscribe", description="Subscribe this channel to geobot.")
     async def subscribe(ctx: commands.Context):
-        if ctx.channel.id in GEO.subscribed:
-            await ctx.reply("This channel is already subscribed to geobot.")
-        else:
-            GEO.subscribe(ctx.channel.id)
+        if await GEO.subscribe(ctx.channel.id):
             await ctx.reply("This channel is now subscribed to the geobot!")
+        else:
+            await ctx.reply("This channel is already subscribed to geobot.")
 
     @geo.command(
         name="unsubscribe", description="Unsubscribe this channel from geobot."
     )
     @subscriber_only()
     async def unsubscribe(ctx: commands.Context):
-        GEO.unsubscribe(ctx.channel.id)
+        await GEO.unsubscribe(ctx.channel.id)
         await ctx.reply("This channel is now unsubscribed from the geobot!")
 
     @geo.command(name="guess", description="Submit a guess for a given image tag.")
@@ -87,13 +136,16 @@ def start():
     @discord.app_commands.describe(latitude="Latitude (in degrees) of guess.")
     @discord.app_commands.describe(longitude="Longitude (in degrees) of guess.")
     async def guess(ctx: commands.Context, tag: str, latitude: float, longitude: float):
-        guess = GEO.new_guess(ctx.message, tag, latitude, longitude)
-        await ctx.reply(f"You have guessed {guess.google_maps_linked_url()}.")
+        guess_url = await GEO.new_guess(
+            ctx.author.id, ctx.channel.id, ctx.message.id, tag, latitude, longitude
+        )
+        await ctx.reply(f"You have guessed {guess_url}.")
 
     @geo.command(name="list", description="List all active image tags.")
     async def list_active(ctx: commands.Context):
-        if len(GEO.images) > 0:
-            tags_str = ", ".join(f"`{tag}`" for tag in GEO.images)
+        tags = await GEO.active_tags(ctx.author.id)
+        if len(tags) > 0:
+            tags_str = ", ".join(f"`{tag}`" for tag in tags)
             await ctx.reply(f"Active tags: {tags_str}.")
         else:
             await ctx.reply(f"There are no active tags.")
@@ -134,11 +186,13 @@ def start():
             await ctx.reply("Please attach exactly one image.")
             return
 
-        if tag is not None and not tag.isalnum():
-            await ctx.reply("Image tags must be alphanumeric.")
+        if tag is not None and not (tag.isalnum() or await GEO.is_tag(tag)):
+            await ctx.reply(
+                "Image tags must be alphanumeric or words joined by dashes."
+            )
             return
 
-        if tag is not None and tag in GEO.images:
+        if tag is not None and await GEO.tag_in_use(ctx.message.author.id, tag):
             await ctx.reply(f"Tag `{tag}` is already in use.")
             return
 
@@ -147,7 +201,7 @@ def start():
 
         async with aiohttp.ClientSession() as session:
             async with session.get(image.url) as response:
-                data = io.BytesIO(await response.read())
+                data = await response.read()
                 real_tag = await GEO.new_image(
                     ctx.message.author.id, data, ext, latitude, longitude, tag
                 )
@@ -158,9 +212,20 @@ def start():
     @geo.command(name="close", description="Close an image tag.")
     @discord.app_commands.describe(tag="The tag to close.")
     async def close_image(ctx: commands.Context, tag: str):
-        await GEO.close_image(tag)
+        await GEO.close_image(ctx.message.author.id, tag)
         await ctx.reply(f"Tag `{tag}` has been closed.")
 
+    @geo.command(
+        name="close-all", description="Close every open image of your selected trip."
+    )
+    async def close_all(ctx: commands.Context):
+        tags = await GEO.close_all(ctx.message.author.id)
+        if len(tags) == 0:
+            await ctx.reply("There are no active tags.")
+            return
+        tags_str = ", ".join(f"`{tag}`" for tag in tags)
+        await ctx.reply(f"Closed {len(tags)} tags: {tags_str}.")
+
     @geo.command(name="reset", description="Reset all scores.")
     @admin_only()
     async def reset_scores(ctx: commands.Context):
@@ -170,9 +235,54 @@ def start():
     @geo.command(name="scores", description="List current scores.")
     @subscriber_admin_only()
     async def show_scores(ctx: commands.Context):
-        ret_str = "## Current scores are:"
-        for user, score in GEO.scores.items():
-            ret_str += f"\n<@{user}>: {score}"
+        await ctx.reply(await GEO.scores_text())
+
+    @geo.command(name="limits", description="Show how many commands were rate limited.")
+    @admin_only()
+    async def show_limits(ctx: commands.Context):
+        if len(ADMISSION.rejections) == 0:
+            await ctx.reply("No commands have been rate limited.")
+            return
+        ret_str = "## Rejected commands:"
+        for command, counts in ADMISSION.rejections.items():
+            counts_str = ", ".join(
+                f"{count} by {kind}" for kind, count in counts.items()
+            )
+            ret_str += f"\n`/{command}`: {counts_str}"
+        ret_str += f"\n{ADMISSION.waiting} commands waiting to run."
+        await ctx.reply(ret_str)
+
+    @geo.command(name="lag", description="Show what has recently blocked the bot.")
+    @admin_only()
+    async def show_lag(ctx: commands.Context):
+        summary = WATCHDOG.summary()
+        if len(summary) == 0:
+            await ctx.reply("The bot hasn't been blocked recently.")
+            return
+        ret_str = f"## Blocked for over {WATCHDOG.threshold}s by:"
+        for culprit, count, total, longest in summary:
+            ret_str += f"\n`{culprit}`: {count} times, {total:.2f}s total, longest {longest:.2f}s"
+        await ctx.reply(ret_str)
+
+    @geo.command(name="replication", description="Show how far behind the standby is.")
+    @admin_only()
+    async def show_replication(ctx: commands.Context):
+        status = await GEO.replication_status()
+        if status is None:
+            await ctx.reply(
+                "Replication is off. Set `GEOBOT_REPLICATE=1` to enable it."
+            )
+            return
+        if not status["connected"]:
+            await ctx.reply(
+                f"The standby isn't connected. It last acknowledged update {status['acked']} of {status['published']}."
+            )
+            return
+        ret_str = f"## Standby is {status['behind']} updates behind (acknowledged {status['acked']} of {status['published']})"
+        for name, key in [("Acknowledged", "ack_lag"), ("Applied", "apply_lag")]:
+            if status[key] is not None:
+                last, average, worst = status[key]
+                ret_str += f"\n{name} after {last * 1000:.1f}ms (average {average * 1000:.1f}ms, worst {worst * 1000:.1f}ms)"
         await ctx.reply(ret_str)
 
     @geo.group()
@@ -197,12 +307,22 @@ def start():
         await GEO.select_trip(ctx.message.author.id, id)
         await ctx.reply(f"Selected trip `{id}`.")
 
+    @trip.command(
+        name="archive", description="Close all of a trip's images and end the trip."
+    )
+    @discord.app_commands.describe(
+        id="Unique ID of this trip. May contain letters, numbers, and dashes."
+    )
+    async def archive_trip(ctx: commands.Context, id):
+        tags = await GEO.archive_trip(ctx.message.author.id, id)
+        await ctx.reply(f"Archived trip `{id}` and closed {len(tags)} tags.")
+
     @trip.command(name="subscribe", description="Subscribe this channel to a trip.")
     @discord.app_commands.describe(
         id="Unique ID of this trip. May contain letters, numbers, and dashes."
     )
     async def trip_subscribe(ctx: commands.Context, id):
-        GEO.trip_subscribe(ctx.channel.id, id)
+        await GEO.trip_subscribe(ctx.channel.id, id)
         await ctx.reply(f"This channel is now subscribed to trip `{id}`!")
 
     @trip.command(
@@ -212,7 +332,7 @@ def start():
         id="Unique ID of this trip. May contain letters, numbers, and dashes."
     )
     async def trip_unsubscribe(ctx: commands.Context, id):
-        GEO.trip_unsubscribe(ctx.channel.id, id)
+        await GEO.trip_unsubscribe(ctx.channel.id, id)
         await ctx.reply(f"This channel is now unsubscribed from trip `{id}`!")
 
     @geo.group()
@@ -221,22 +341,53 @@ def start():
 
     @map.command(name="reset", description="Reset map to world map default.")
     async def reset_map(ctx: commands.Context):
-        GEO.set_maxdist()
+        maxdist = await GEO.set_maxdist(None)
         await ctx.reply(
-            f"Maximum map distance has been set to {GEO.maxdist} (world map default)."
+            f"Maximum map distance has been set to {maxdist} (world map default)."
         )
 
     @map.command(
         name="set",
-        description="Reset map to the given max distance (diagonal length of map rectangle).",
+        description="Set the max distance for trips with fewer than two image locations.",
     )
     @discord.app_commands.describe(maxdist="Diagonal length of the map rectangle.")
     async def set_map(ctx: commands.Context, maxdist: float):
-        GEO.set_maxdist(maxdist)
-        await ctx.reply(f"Maximum map distance has been set to {GEO.maxdist}.")
+        maxdist = await GEO.set_maxdist(maxdist)
+        await ctx.reply(f"Maximum map distance has been set to {maxdist}.")
+
+    @map.command(
+        name="preview",
+        description="Preview how current scores would change with a new max distance.",
+    )
+    @discord.app_commands.describe(maxdist="Diagonal length of the map rectangle.")
+    @discord.app_commands.describe(
+        all_trips="Also re-score trips that have their own map size."
+    )
+    @admin_only()
+    async def preview_map(
+        ctx: commands.Context, maxdist: float, all_trips: bool = False
+    ):
+        await reply_long(ctx, await GEO.preview_maxdist_text(maxdist, all_trips))
+
+    async def setup_hook():
+        WATCHDOG.start()
+        await GEO.start()
+
+    bot.setup_hook = setup_hook
+
+    # Stop the engine (and its process, if it has one) along with the bot
+    close = bot.close
+
+    async def close_bot():
+        WATCHDOG.stop()
+        await GEO.stop()
+        await close()
+
+    bot.close = close_bot  # type: ignore[method-assign]
 
     @bot.event
     async def on_command_error(ctx: commands.Context, err):
+        await ADMISSION.release(ctx)
         await error.handle_error(ctx, err)
 
     token: str
@@ -0,0 +1,421 @@
+from discord.ext import commands
+import asyncio
+import io
+import pathlib
+import sys
+import typing
+import os
+
+from . import geoguesser
+from . import outbox
+from . import ipc
+from . import watchdog
+from . import replication
+from . import lockfile
+from . import error
+
+PARENT_PATH = pathlib.Path(__file__).parent
+DATA_PATH = pathlib.Path(PARENT_PATH, "data")
+SOCKET_PATH = pathlib.Path(DATA_PATH, "engine.sock")
+
+# How long the gateway waits for a freshly started engine process to listen
+CONNECT_TIMEOUT = 30.0
+CONNECT_INTERVAL = 0.1
+# How long the gateway waits for the engine process to shut down cleanly
+STOP_TIMEOUT = 10.0
+
+# Engine methods callable by the gateway. Arguments and results are plain data
+# so they can cross a process boundary
+OPERATIONS = [
+    "is_subscribed",
+    "is_admin",
+    "subscribe",
+    "unsubscribe",
+    "new_guess",
+    "active_tags",
+    "tag_in_use",
+    "is_tag",
+    "message_subscribers",
+    "new_image",
+    "close_image",
+    "close_all",
+    "archive_trip",
+    "reset_scores",
+    "scores_text",
+    "new_trip",
+    "select_trip",
+    "trip_subscribe",
+    "trip_unsubscribe",
+    "set_maxdist",
+    "preview_maxdist_text",
+    "replication_status",
+]
+
+
+# The game state and everything done with it, behind the interface bot.py
+# uses. Runs in the gateway's process by default, or in an engine process
+# behind a RemoteEngine.
+class Engine:
+    geo: geoguesser.Geoguesser
+
+    # Streams the game state to a standby process, if GEOBOT_REPLICATE is set
+    replicator: typing.Optional[replication.Replicator]
+
+    # Computes closed guess distances in a worker thread at startup
+    _warmup: typing.Optional[asyncio.Future]
+
+    def __init__(self, geo: geoguesser.Geoguesser):
+        self.geo = geo
+        self.replicator = None
+        self._warmup = None
+
+    async def start(self):
+        self.geo.outbox.start()
+        if os.environ.get("GEOBOT_REPLICATE"):
+            self.replicator = replication.Replicator(self.geo)
+            self.replicator.start()
+        # Compute closed guess distances up front so the first preview is fast
+        self._warmup = asyncio.get_running_loop().run_in_executor(
+            None, self.geo.replay.update, self.geo.trips
+        )
+
+    async def stop(self):
+        await self.geo.outbox.stop()
+        self.geo.flush()
+        if self.replicator is not None:
+            await self.replicator.stop()
+
+    async def is_subscribed(self, channel: int) -> bool:
+        return channel in self.geo.subscribed
+
+    async def is_admin(self, channel: int) -> bool:
+        return channel in self.geo.admins
+
+    # Returns False if the channel was already subscribed
+    async def subscribe(self, channel: int) -> bool:
+        if channel in self.geo.subscribed:
+            return False
+        self.geo.subscribe(channel)
+        return True
+
+    async def unsubscribe(self, channel: int):
+        self.geo.unsubscribe(channel)
+
+    # Returns a link to the guessed location
+    async def new_guess(
+        self,
+        player: int,
+        channel_id: int,
+        message_id: int,
+        tag: str,
+        lat: float,
+        long: float,
+    ) -> str:
+        guess = self.geo.new_guess(
+            player,
+            geoguesser.MessageID(channel_id=channel_id, message_id=message_id),
+            tag,
+            lat,
+            long,
+        )
+        return guess.google_maps_linked_url()
+
+    # Open tags of the player's selected trip
+    async def active_tags(self, player: int) -> list[str]:
+        return list(self.geo.trips[self.geo.get_selected_trip(player)].images)
+
+    async def tag_in_use(self, player: int, tag: str) -> bool:
+        return tag in self.geo.trips[self.geo.get_selected_trip(player)].images
+
+    async def is_tag(self, tag: str) -> bool:
+        return self.geo.tag_bank.is_tag(tag)
+
+    async def message_subscribers(self, content: str):
+        self.geo.message_subscribers(content)
+
+    # Returns the image's tag
+    async def new_image(
+        self,
+        player: int,
+        image: bytes,
+        ext: str,
+        lat: float,
+        long: float,
+        tag: typing.Optional[str],
+    ) -> str:
+        return await self.geo.new_image(player, io.BytesIO(image), ext, lat, long, tag)
+
+    async def close_image(self, player: int, tag: str):
+        self.geo.close_image(player, tag)
+
+    # Returns the closed tags
+    async def close_all(self, player: int) -> list[str]:
+        return self.geo.close_all(player)
+
+    # Returns the closed tags
+    async def archive_trip(self, player: int, id: str) -> list[str]:
+        return self.geo.archive_trip(player, id)
+
+    async def reset_scores(self):
+        self.geo.reset_scores()
+
+    async def scores_text(self) -> str:
+        ret_str = "## Current scores are:"
+        for user, score in self.geo.scores.items():
+            ret_str += f"\n<@{user}>: {score}"
+        return ret_str
+
+    async def new_trip(self, id: str, player: int):
+        await self.geo.new_trip(id, player)
+
+    async def select_trip(self, player: int, id: str):
+        await self.geo.select_trip(player, id)
+
+    async def trip_subscribe(self, channel: int, id: str):
+        self.geo.trip_subscribe(channel, id)
+
+    async def trip_unsubscribe(self, channel: int, id: str):
+        self.geo.trip_unsubscribe(channel, id)
+
+    # Set the global maxdist, or reset it to the world map if None
+    async def set_maxdist(self, maxdist: typing.Optional[float]) -> float:
+        if maxdist is None:
+            self.geo.set_maxdist()
+        else:
+            self.geo.set_maxdist(maxdist)
+        return self.geo.maxdist
+
+    async def preview_maxdist_text(
+        self, maxdist: float, all_trips: bool = False
+    ) -> str:
+        # The replay engine can't be updated while the warm-up is, so wait for
+        # it without blocking the loop. Raises if the warm-up failed
+        if self._warmup is not None:
+            await self._warmup
+        diffs = self.geo.preview_maxdist(maxdist, all_trips)
+        if len(diffs) == 0:
+            return "There are no closed guesses to re-score."
+        scope = "all trips" if all_trips else "trips without their own map size"
+        ret_str = f"## Current scores if guesses on {scope} had used max distance {maxdist} (currently {self.geo.maxdist}):"
+        for diff in diffs:
+            ret_str += f"\n<@{diff.user}>: {diff.old} → {diff.new} ({diff.change:+d})"
+        fixed = self.geo.fixed_map_trips()
+        if all_trips:
+            ret_str += (
+                f"\n`/geo map set` only changes trips without their own map size."
+            )
+        elif fixed:
+            fixed_str = ", ".join(f"`{id}`" for id in fixed)
+            ret_str += f"\nTrips {fixed_str} use their own map size and aren't affected. Preview with `all_trips` to include them."
+        if not self.geo.preview_is_exact():
+            ret_str += f"\nScores were last reset before resets were recorded, so these re-score every closed guess and may not match the current scores until the next `/geo reset`."
+        ret_str += f"\nRun `/geo map set {maxdist}` to use this max distance."
+        return ret_str
+
+    # None if the game state isn't being replicated
+    async def replication_status(self) -> typing.Optional[dict]:
+        if self.replicator is None:
+            return None
+        return self.replicator.status()
+
+
+# Gateway-side stand-in for an Engine running in an engine process. Calls to
+# the OPERATIONS are forwarded over a unix socket, and the engine's outbound
+# messages come back as "deliver" requests that are sent through the bot.
+class RemoteEngine:
+    bot: commands.Bot
+    socket_path: os.PathLike
+
+    # Whether to start the engine process, rather than connect to one
+    # started separately
+    spawn: bool
+
+    conn: typing.Optional[ipc.Connection]
+    process: typing.Optional[asyncio.subprocess.Process]
+
+    def __init__(
+        self,
+        bot: commands.Bot,
+        socket_path: typing.Optional[os.PathLike] = None,
+        spawn: bool = True,
+    ):
+        self.bot = bot
+        self.socket_path = SOCKET_PATH if socket_path is None else socket_path
+        self.spawn = spawn
+        self.conn = None
+        self.process = None
+
+    async def start(self):
+        await self._connect()
+
+    # Shuts down the engine process too, if this gateway manages engines
+    async def stop(self):
+        if self.spawn and self.conn is not None and not self.conn.closed:
+            try:
+                await asyncio.wait_for(self.conn.request("shutdown"), STOP_TIMEOUT)
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+        if self.conn is not None:
+            self.conn.close()
+        if self.process is not None and self.process.returncode is None:
+            try:
+                await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.process.terminate()
+                await self.process.wait()
+
+    async def _connect(self):
+        # An engine left running by an earlier gateway is adopted rather than
+        # replaced
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        else:
+            self._start_conn(reader, writer)
+            return
+
+        if self.spawn and (self.process is None or self.process.returncode is not None):
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "geobot.engine", str(self.socket_path)
+            )
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CONNECT_TIMEOUT
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # e.g. another process holds the game state
+                if self.process is not None and self.process.returncode is not None:
+                    raise ConnectionError(
+                        f"Engine process exited with status {self.process.returncode}"
+                    )
+                if loop.time() > deadline:
+                    raise ConnectionError(
+                        f"Engine process didn't start listening on {self.socket_path}"
+                    )
+                await asyncio.sleep(CONNECT_INTERVAL)
+        self._start_conn(reader, writer)
+
+    def _start_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.conn = ipc.Connection(reader, writer, {"deliver": self._deliver})
+        self.conn.start()
+
+    async def _deliver(
+        self, item: dict, message_id: typing.Optional[int]
+    ) -> tuple[int, int]:
+        return await outbox.deliver_with_bot(
+            self.bot, outbox.OutboxItem.from_ser(item), message_id
+        )
+
+    async def call(self, operation: str, *args) -> typing.Any:
+        if self.conn is None or self.conn.closed:
+            await self._connect()
+        assert self.conn is not None
+        return await self.conn.request(operation, *args)
+
+    def __getattr__(self, name: str):
+        if name not in OPERATIONS:
+            raise AttributeError(name)
+
+        async def operation(*args):
+            return await self.call(name, *args)
+
+        return operation
+
+
+# The engine process: serves an Engine to one gateway at a time, and sends its
+# outbound messages back through whichever gateway is connected. Messages
+# queued while no gateway is connected wait in the outbox until one connects.
+class EngineServer:
+    engine: Engine
+    conn: typing.Optional[ipc.Connection]
+
+    _stopped: asyncio.Event
+
+    def __init__(self):
+        self.conn = None
+        self.engine = Engine(geoguesser.Geoguesser(None, deliver=self.deliver))
+        self._stopped = asyncio.Event()
+
+    async def deliver(
+        self, item: outbox.OutboxItem, message_id: typing.Optional[int]
+    ) -> tuple[int, int]:
+        if self.conn is None or self.conn.closed:
+            raise error.DeliveryPaused("No gateway is connected")
+        try:
+            channel_id, message_id = await self.conn.request(
+                "deliver", item.as_ser(), message_id
+            )
+        except ConnectionError as e:
+            # A gateway that has already replaced the lost one can retry it
+            if self.conn is not None and not self.conn.closed:
+                raise error.DeliveryFailed(str(e))
+            raise error.DeliveryPaused(str(e))
+        return channel_id, message_id
+
+    async def serve(self, socket_path: os.PathLike):
+        # Only one engine may own the socket, and only one process (engine, bot
+        # or standby that took over) the game state
+        lock = lockfile.LockFile(f"{socket_path}.lock")
+        if not lock.acquire():
+            raise error.AlreadyRunning(str(lock.path), lock.holder())
+        active = lockfile.LockFile(replication.ACTIVE_LOCK_PATH)
+        if not active.acquire():
+            lock.release()
+            raise error.AlreadyRunning(str(active.path), active.holder())
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        server = await asyncio.start_unix_server(self._on_connect, socket_path)
+        # Stalls here don't block the gateway, but are still worth logging
+        lag = watchdog.Watchdog()
+        lag.start()
+        await self.engine.start()
+        try:
+            async with server:
+                await self._stopped.wait()
+        finally:
+            lag.stop()
+            active.release()
+            lock.release()
+
+    # Requested by the gateway when it shuts down
+    async def shutdown(self):
+        await self.engine.stop()
+        self._stopped.set()
+
+    async def _on_connect(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        if self.conn is not None:
+            self.conn.close()
+        conn = ipc.Connection(
+            reader,
+            writer,
+            {
+                **{name: getattr(self.engine, name) for name in OPERATIONS},
+                "shutdown": self.shutdown,
+            },
+        )
+        self.conn = conn
+        conn.start()
+        self.engine.geo.outbox.resume()
+        await conn.wait_closed()
+
+
+def main():
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH
+    try:
+        asyncio.run(EngineServer().serve(socket_path))
+    except KeyboardInterrupt:
+        pass
+    except error.AlreadyRunning as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
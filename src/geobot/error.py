@@ -4,6 +4,7 @@ import traceback
 import sys
 import typing
 import logging
+import math
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -20,6 +21,64 @@ class AdminOnly(commands.CheckFailure):
     pass
 
 
+class RateLimited(commands.CommandError):
+    command: str
+    # "user" or "channel"
+    kind: str
+    retry_after: float
+    # Whether to tell the user. False once they've already been told
+    notify: bool
+
+    def __init__(self, command: str, kind: str, retry_after: float, notify: bool):
+        self.command = command
+        self.kind = kind
+        self.retry_after = retry_after
+        self.notify = notify
+
+
+class Overloaded(commands.CommandError):
+    command: str
+
+    def __init__(self, command: str):
+        self.command = command
+
+
+# An outbound message that can never be delivered (e.g. missing permissions)
+class Undeliverable(Exception):
+    pass
+
+
+# An outbound message that failed to deliver but may succeed if retried
+class DeliveryFailed(Exception):
+    pass
+
+
+# Nothing can be delivered right now (e.g. no gateway is connected). Doesn't
+# count as a failed attempt: the item waits for Outbox.resume()
+class DeliveryPaused(Exception):
+    pass
+
+
+# An exception from the engine process with no local equivalent
+class RemoteError(Exception):
+    type: str
+
+    def __init__(self, type: str, *args):
+        super().__init__(*args)
+        self.type = type
+
+
+# Another process holds a lock file, e.g. a second engine or bot
+class AlreadyRunning(Exception):
+    path: str
+    pid: typing.Optional[int]
+
+    def __init__(self, path: str, pid: typing.Optional[int]):
+        super().__init__(f"Another process (PID {pid}) holds {path}")
+        self.path = path
+        self.pid = pid
+
+
 class TagSelectFailure(Exception):
     pass
 
@@ -72,8 +131,27 @@ class NotTripSubscriber(Exception):
         self.id = id
 
 
+class TripArchived(Exception):
+    id: str
+
+    def __init__(self, id: str):
+        self.id = id
+
+
 async def handle_error(ctx: commands.Context, error):
-    if isinstance(error, SubscriberOnly):
+    if isinstance(error, RateLimited):
+        # Slash commands must always get a response
+        if error.notify or ctx.interaction is not None:
+            await ctx.reply(
+                f"Slow down! Try `/{error.command}` again in {math.ceil(error.retry_after)}s.",
+                ephemeral=True,
+            )
+    elif isinstance(error, Overloaded):
+        await ctx.reply(
+            f"Geobot is busy. Try `/{error.command}` again in a moment.",
+            ephemeral=True,
+        )
+    elif isinstance(error, SubscriberOnly):
         await ctx.reply(
             f"This channel is not subscribed to the geobot.\nRun `/geo subscribe` to subscribe."
         )
@@ -114,6 +192,8 @@ async def handle_error(ctx: commands.Context, error):
             await ctx.reply(
                 f"You can only perform this action when you are an owner of your selected trip. You are not an owner of trip `{id}`."
             )
+        elif isinstance(error.original, TripArchived):
+            await ctx.reply(f"Trip `{error.original.id}` has been archived.")
         elif isinstance(error.original, NotTripSubscriber):
             await ctx.reply(
                 f"This channel is not subscribed to trip `{id}`. Subscribe with `/geo trip subscribe {id}`"
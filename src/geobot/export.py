@@ -0,0 +1,327 @@
+from array import array
+import argparse
+import csv
+import json
+import struct
+import sys
+import typing
+
+import discord
+
+from . import geoguesser
+from . import extent
+from . import replay
+
+# Columns of an exported guess, with the array typecode used for each in the
+# columnar format ("s" marks a string column)
+COLUMNS: list[tuple[str, str]] = [
+    ("trip", "s"),
+    ("tag", "s"),
+    ("status", "s"),
+    ("user", "q"),
+    ("guess_latitude", "d"),
+    ("guess_longitude", "d"),
+    ("true_latitude", "d"),
+    ("true_longitude", "d"),
+    ("distance", "d"),
+    ("maxdist", "d"),
+    ("score", "q"),
+    ("guessed_at", "d"),
+    ("posted_at", "d"),
+]
+
+COLUMNAR_MAGIC = b"GEOCOL1\n"
+# Rows buffered per row group of the columnar format
+ROW_GROUP_SIZE = 4096
+# Characters read from the data file at a time
+READ_SIZE = 1 << 16
+# Stand-in for values a row doesn't have (score of an open image or one closed
+# before its maxdist was recorded, timestamp of a message that was never
+# delivered)
+MISSING_INT = -1
+MISSING_FLOAT = float("nan")
+
+
+# Discord IDs embed their creation time. Returns a POSIX timestamp
+def message_time(message_id: int) -> float:
+    if message_id == 0:
+        return MISSING_FLOAT
+    return discord.utils.snowflake_time(message_id).timestamp()
+
+
+# Reads a JSON document from a file a value at a time, so only the value being
+# read is ever in memory. Objects and arrays can be walked with items() and
+# elements() instead of being read whole.
+class JSONStream:
+    f: typing.TextIO
+    buf: str
+    pos: int
+    eof: bool
+
+    _decoder: json.JSONDecoder
+
+    def __init__(self, f: typing.TextIO):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON data")
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(
+                f"Expected {char!r} at {self.buf[self.pos:self.pos + 20]!r}"
+            )
+        self.pos += 1
+
+    # Reads the next value whole
+    def value(self) -> typing.Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # The value may continue past the buffer
+                if self._fill():
+                    continue
+                raise
+            # A number may have been cut off by the end of the buffer (e.g.
+            # "60." read as 60), so only trust a value followed by a delimiter
+            cut_off = end == len(self.buf) or self.buf[end] not in ",:]} \t\r\n"
+            if cut_off and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    # Walks the next value, which must be an object. Yields each key, after
+    # which the caller must read its value (e.g. with value())
+    def items(self) -> typing.Iterator[str]:
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(":")
+            yield key
+            if self._peek() == "}":
+                self.pos += 1
+                return
+            self._expect(",")
+
+    # Walks the next value, which must be an array. Yields before each element,
+    # which the caller must then read
+    def elements(self) -> typing.Iterator[None]:
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self._peek() == "]":
+                self.pos += 1
+                return
+            self._expect(",")
+
+
+# Rows of one serialized image, read straight from its saved form
+def image_rows(trip: str, ser: dict, status: str) -> typing.Iterator[tuple]:
+    maxdist = ser.get("maxdist")
+    posted_at = (
+        message_time(ser["image_messages"][0]["message"])
+        if ser["image_messages"]
+        else MISSING_FLOAT
+    )
+    for user, guess in ser["guesses"].items():
+        dist = extent.geodesic_distance(
+            guess["latitude"], guess["longitude"], ser["latitude"], ser["longitude"]
+        )
+        yield (
+            trip,
+            ser["tag"],
+            status,
+            int(user),
+            guess["latitude"],
+            guess["longitude"],
+            ser["latitude"],
+            ser["longitude"],
+            dist,
+            MISSING_FLOAT if maxdist is None else maxdist,
+            MISSING_INT if maxdist is None else replay.exp_score(dist, maxdist),
+            message_time(guess["message"]["message"]),
+            posted_at,
+        )
+
+
+# Rows of the trip being walked: closed images in order, then open ones
+def _trip_rows(stream: JSONStream, id: str) -> typing.Iterator[tuple]:
+    open_images = []
+    for key in stream.items():
+        if key == "images":
+            # Only the open images are held until the trip ends
+            for _ in stream.items():
+                open_images.append(stream.value())
+        elif key == "closed_images":
+            for _ in stream.elements():
+                yield from image_rows(id, stream.value(), "closed")
+        else:
+            stream.value()
+    for ser in open_images:
+        yield from image_rows(id, ser, "open")
+
+
+# Every guess in a saved game state, read one image at a time so memory doesn't
+# grow with history. Scores are the ones awarded, from the maxdist each image
+# closed with
+def iter_rows(f: typing.TextIO) -> typing.Iterator[tuple]:
+    stream = JSONStream(f)
+    legacy_open = []
+    for key in stream.items():
+        if key == "trips":
+            for id in stream.items():
+                yield from _trip_rows(stream, id)
+        # Images from before trips existed
+        elif key == "images":
+            for _ in stream.items():
+                legacy_open.append(stream.value())
+        elif key == "closed_images":
+            for _ in stream.elements():
+                yield from image_rows(geoguesser.DEFAULT_TRIP, stream.value(), "closed")
+        else:
+            stream.value()
+    for ser in legacy_open:
+        yield from image_rows(geoguesser.DEFAULT_TRIP, ser, "open")
+
+
+def write_csv(rows: typing.Iterable[tuple], out: typing.TextIO):
+    writer = csv.writer(out)
+    writer.writerow([name for name, _ in COLUMNS])
+    for row in rows:
+        writer.writerow(row)
+
+
+def _encode_column(typecode: str, values: list) -> bytes:
+    if typecode != "s":
+        return array(typecode, values).tobytes()
+    encoded = [v.encode() for v in values]
+    offsets = array("I", [0])
+    for e in encoded:
+        offsets.append(offsets[-1] + len(e))
+    return offsets.tobytes() + b"".join(encoded)
+
+
+def _decode_column(typecode: str, count: int, data: bytes) -> list:
+    if typecode != "s":
+        col = array(typecode)
+        col.frombytes(data)
+        return col.tolist()
+    offsets = array("I")
+    offsets_size = (count + 1) * offsets.itemsize
+    offsets.frombytes(data[:offsets_size])
+    blob = data[offsets_size:]
+    return [blob[offsets[i] : offsets[i + 1]].decode() for i in range(count)]
+
+
+# Compact binary format: a magic line, a JSON schema line, then row groups of at
+# most ROW_GROUP_SIZE rows. Each row group is a little-endian uint32 row count
+# followed by each column as a uint32 byte length and the column's bytes.
+# Numeric columns are raw arrays in native byte order; string columns are
+# uint32 offsets followed by the concatenated UTF-8 values.
+def write_columnar(rows: typing.Iterable[tuple], out: typing.BinaryIO):
+    out.write(COLUMNAR_MAGIC)
+    schema = {
+        "columns": [[name, typecode] for name, typecode in COLUMNS],
+        "byteorder": sys.byteorder,
+    }
+    out.write(json.dumps(schema).encode() + b"\n")
+
+    group: list[tuple] = []
+    for row in rows:
+        group.append(row)
+        if len(group) == ROW_GROUP_SIZE:
+            _write_row_group(group, out)
+            group = []
+    if group:
+        _write_row_group(group, out)
+
+
+def _write_row_group(group: list[tuple], out: typing.BinaryIO):
+    out.write(struct.pack("<I", len(group)))
+    for i, (_, typecode) in enumerate(COLUMNS):
+        data = _encode_column(typecode, [row[i] for row in group])
+        out.write(struct.pack("<I", len(data)))
+        out.write(data)
+
+
+# Yields rows back out of a file written by write_columnar, one row group at a
+# time
+def read_columnar(f: typing.BinaryIO) -> typing.Iterator[tuple]:
+    if f.readline() != COLUMNAR_MAGIC:
+        raise ValueError("Not a geobot columnar export")
+    schema = json.loads(f.readline())
+    if schema["byteorder"] != sys.byteorder:
+        raise ValueError(f"Export was written on a {schema['byteorder']}-endian host")
+    typecodes = [typecode for _, typecode in schema["columns"]]
+
+    while header := f.read(4):
+        (count,) = struct.unpack("<I", header)
+        columns = []
+        for typecode in typecodes:
+            (size,) = struct.unpack("<I", f.read(4))
+            columns.append(_decode_column(typecode, count, f.read(size)))
+        yield from zip(*columns)
+
+
+def main(argv: typing.Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Export every guess as one flat row per guess."
+    )
+    parser.add_argument("output", help="File to write to. Use - for stdout (CSV only).")
+    parser.add_argument(
+        "--format", choices=["csv", "columnar"], default="csv", help="Output format."
+    )
+    parser.add_argument(
+        "--input",
+        default=geoguesser.JSON_PATH,
+        help="Geobot data file to read. Defaults to the bot's own data.json.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.format == "columnar" and args.output == "-":
+        parser.error("columnar output can't be written to stdout")
+
+    with open(args.input) as f:
+        rows = iter_rows(f)
+        if args.format == "csv":
+            if args.output == "-":
+                write_csv(rows, sys.stdout)
+            else:
+                with open(args.output, "w", newline="") as out:
+                    write_csv(rows, out)
+        else:
+            with open(args.output, "wb") as out:
+                write_columnar(rows, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+from array import array
+from geographiclib.geodesic import Geodesic
+import math
+import typing
+
+# Same ellipsoid and algorithm as geopy's distance.distance, without the
+# per-call overhead of building Point and Distance objects
+GEODESIC = Geodesic.WGS84
+
+# Geodesic distances on the ellipsoid differ from great-circle distances by
+# well under this fraction, so any point this close to the most antipodal one
+# (by angle) could still be the farthest by geodesic distance
+ELLIPSOID_SLACK = 0.01
+
+
+def geodesic_distance(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    return GEODESIC.Inverse(lat1, long1, lat2, long2, Geodesic.DISTANCE)["s12"]
+
+
+# Tracks the geodesic diameter (largest distance between any two points) of a
+# growing set of locations.
+#
+# Every point on a sphere is a vertex of the set's convex hull, so the hull
+# can't prune candidates. Instead each point is kept as a unit vector, and when
+# a point is added only its most antipodal partners (smallest dot product) are
+# measured geodesically. Adding a point costs one pass of dot products plus a
+# handful of geodesics instead of a geodesic to every other point.
+class Diameter:
+    lats: array
+    longs: array
+    xs: array
+    ys: array
+    zs: array
+
+    # Largest distance (meters) between two added points
+    diameter: float
+
+    # Indices of the two points at distance `diameter`
+    pair: tuple[int, int]
+
+    def __init__(self):
+        self.lats = array("d")
+        self.longs = array("d")
+        self.xs = array("d")
+        self.ys = array("d")
+        self.zs = array("d")
+        self.diameter = 0.0
+        self.pair = (0, 0)
+
+    def __len__(self) -> int:
+        return len(self.lats)
+
+    # The points' diameter, restored from as_ser() if it covers exactly these
+    # points, which skips the dot products entirely. Otherwise it's recomputed.
+    @classmethod
+    def from_points(
+        cls,
+        points: typing.Iterable[tuple[float, float]],
+        ser: typing.Optional[dict] = None,
+    ) -> typing.Self:
+        diameter = cls()
+        points = list(points)
+        if ser is None or ser["count"] != len(points):
+            for lat, long in points:
+                diameter.add(lat, long)
+            return diameter
+
+        for lat, long in points:
+            diameter._append(lat, long, *_unit(lat, long))
+        diameter.diameter = ser["diameter"]
+        # Points are stored rather than indices, since the caller's order can
+        # change (e.g. a trip lists closed images first)
+        ends = [tuple(end) for end in ser["pair"]]
+        pair = [i for i, point in enumerate(points) if tuple(point) in ends][:2]
+        if len(pair) == 2:
+            diameter.pair = (pair[0], pair[1])
+        return diameter
+
+    def as_ser(self) -> dict:
+        i, j = self.pair
+        return {
+            "diameter": self.diameter,
+            "pair": (
+                [[self.lats[i], self.longs[i]], [self.lats[j], self.longs[j]]]
+                if len(self) > 0
+                else []
+            ),
+            "count": len(self),
+        }
+
+    def add(self, lat: float, long: float) -> float:
+        x, y, z = _unit(lat, long)
+
+        if len(self) > 0:
+            dots = [
+                x * px + y * py + z * pz
+                for px, py, pz in zip(self.xs, self.ys, self.zs)
+            ]
+            # Smallest dot product means largest angle
+            best_angle = math.acos(max(-1.0, min(1.0, min(dots))))
+            cutoff = math.cos(best_angle * (1 - ELLIPSOID_SLACK))
+            for i, dot in enumerate(dots):
+                if dot > cutoff:
+                    continue
+                dist = geodesic_distance(lat, long, self.lats[i], self.longs[i])
+                if dist > self.diameter:
+                    self.diameter = dist
+                    self.pair = (i, len(self))
+
+        self._append(lat, long, x, y, z)
+        return self.diameter
+
+    def _append(self, lat: float, long: float, x: float, y: float, z: float):
+        self.lats.append(lat)
+        self.longs.append(long)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+
+
+def _unit(lat: float, long: float) -> tuple[float, float, float]:
+    phi = math.radians(lat)
+    lam = math.radians(long)
+    return math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi)
@@ -0,0 +1,231 @@
+from array import array
+import json
+import pathlib
+import typing
+import math
+import os
+
+PARENT_PATH = pathlib.Path(__file__).parent
+DATA_PATH = pathlib.Path(PARENT_PATH, "data")
+REGIONS_PATH = pathlib.Path(DATA_PATH, "regions.geojson")
+
+# Size (degrees) of the grid cells used to index polygons. A whole number of
+# cache cells
+INDEX_CELL = 1.0
+# Size (degrees) of the cells results are cached for. About 1km at the equator.
+# Only cells no region border crosses are cached
+CACHE_CELL = 0.01
+MAX_CACHE = 100000
+
+# Feature properties tried, in order, for a region's name. Covers Natural
+# Earth's admin-0 (countries) and admin-1 (states/provinces) files
+NAME_PROPERTIES = ["NAME_EN", "NAME", "name", "ADMIN"]
+
+
+# One polygon of a region: an outer ring and any holes, each a flat array of
+# longitude, latitude pairs
+class Polygon:
+    __slots__ = ("region", "rings", "min_long", "min_lat", "max_long", "max_lat")
+
+    region: int
+    rings: list[array]
+    min_long: float
+    min_lat: float
+    max_long: float
+    max_lat: float
+
+    def __init__(self, region: int, rings: list[list[list[float]]]):
+        self.region = region
+        self.rings = [
+            array("d", (c for point in ring for c in point[:2])) for ring in rings
+        ]
+        outer = self.rings[0]
+        self.min_long = min(outer[0::2])
+        self.max_long = max(outer[0::2])
+        self.min_lat = min(outer[1::2])
+        self.max_lat = max(outer[1::2])
+
+    # Even-odd ray casting over all rings, so holes are excluded
+    def contains(self, lat: float, long: float) -> bool:
+        if not (
+            self.min_lat <= lat <= self.max_lat
+            and self.min_long <= long <= self.max_long
+        ):
+            return False
+        inside = False
+        for ring in self.rings:
+            n = len(ring) // 2
+            x2, y2 = ring[2 * n - 2], ring[2 * n - 1]
+            for i in range(n):
+                x1, y1 = ring[2 * i], ring[2 * i + 1]
+                if (y1 > lat) != (y2 > lat) and long < (x2 - x1) * (lat - y1) / (
+                    y2 - y1
+                ) + x1:
+                    inside = not inside
+                x2, y2 = x1, y1
+        return inside
+
+
+# Offline reverse geocoder over region polygons from a GeoJSON file. The
+# bundled data/regions.geojson has Natural Earth's 1:110m countries; replace it
+# with e.g. ne_10m_admin_0_countries.geojson for more precise borders. Polygons
+# are bucketed into a lat/long grid by bounding box, so a lookup only tests the
+# few polygons near the point. If the file is missing, every lookup returns
+# None.
+class Geocoder:
+    regions_file: os.PathLike
+
+    # Region names, indexed by Polygon.region
+    names: list[str]
+    polygons: list[Polygon]
+
+    # Maps grid cells to indices into polygons
+    grid: dict[tuple[int, int], list[int]]
+
+    # Maps cache cells to region indices (-1 for no region)
+    cache: dict[tuple[int, int], int]
+
+    # Maps grid cells to the cache cells in them that a polygon edge crosses.
+    # Filled in the first time a grid cell is looked up
+    borders: dict[tuple[int, int], set[tuple[int, int]]]
+
+    def __init__(self, regions_file: typing.Optional[os.PathLike] = None):
+        self.regions_file = REGIONS_PATH if regions_file is None else regions_file
+        self.names = []
+        self.polygons = []
+        self.grid = {}
+        self.cache = {}
+        self.borders = {}
+        try:
+            self.load()
+        except FileNotFoundError:
+            pass
+
+    def load(self):
+        with open(self.regions_file) as f:
+            data: dict = json.load(f)
+
+        for feature in data["features"]:
+            geometry = feature.get("geometry")
+            if geometry is None:
+                continue
+            props = feature.get("properties") or {}
+            name = next((props[p] for p in NAME_PROPERTIES if props.get(p)), None)
+            if name is None:
+                continue
+
+            if geometry["type"] == "Polygon":
+                parts = [geometry["coordinates"]]
+            elif geometry["type"] == "MultiPolygon":
+                parts = geometry["coordinates"]
+            else:
+                continue
+
+            region = len(self.names)
+            self.names.append(name)
+            for rings in parts:
+                self._add_polygon(Polygon(region, rings))
+
+    def _add_polygon(self, polygon: Polygon):
+        index = len(self.polygons)
+        self.polygons.append(polygon)
+        for lat_cell in range(
+            _cell(polygon.min_lat, INDEX_CELL), _cell(polygon.max_lat, INDEX_CELL) + 1
+        ):
+            for long_cell in range(
+                _cell(polygon.min_long, INDEX_CELL),
+                _cell(polygon.max_long, INDEX_CELL) + 1,
+            ):
+                self.grid.setdefault((lat_cell, long_cell), []).append(index)
+
+    # Name of the region containing a point, or None
+    def locate(self, lat: float, long: float) -> typing.Optional[str]:
+        if not self.polygons:
+            return None
+        long = (long + 180) % 360 - 180
+
+        key = (_cell(lat, CACHE_CELL), _cell(long, CACHE_CELL))
+        region = self.cache.get(key)
+        if region is None:
+            region = -1
+            grid_key = (_cell(lat, INDEX_CELL), _cell(long, INDEX_CELL))
+            for i in self.grid.get(grid_key, []):
+                if self.polygons[i].contains(lat, long):
+                    region = self.polygons[i].region
+                    break
+            # Every point of a cell no border crosses is in the same region
+            per_cell = round(INDEX_CELL / CACHE_CELL)
+            if key not in self._borders((key[0] // per_cell, key[1] // per_cell)):
+                if len(self.cache) >= MAX_CACHE:
+                    self.cache.clear()
+                self.cache[key] = region
+
+        return self.names[region] if region >= 0 else None
+
+    def _borders(self, grid_key: tuple[int, int]) -> set[tuple[int, int]]:
+        cells = self.borders.get(grid_key)
+        if cells is not None:
+            return cells
+        cells = set()
+        per_cell = round(INDEX_CELL / CACHE_CELL)
+        lat_range = (grid_key[0] * per_cell, (grid_key[0] + 1) * per_cell - 1)
+        long_range = (grid_key[1] * per_cell, (grid_key[1] + 1) * per_cell - 1)
+        south, west = grid_key[0] * INDEX_CELL, grid_key[1] * INDEX_CELL
+        north, east = south + INDEX_CELL, west + INDEX_CELL
+        for i in self.grid.get(grid_key, []):
+            for ring in self.polygons[i].rings:
+                n = len(ring) // 2
+                x2, y2 = ring[2 * n - 2], ring[2 * n - 1]
+                for j in range(n):
+                    x1, y1 = ring[2 * j], ring[2 * j + 1]
+                    # Most of a large polygon's edges are outside the cell
+                    if not (
+                        (x1 < west and x2 < west)
+                        or (x1 > east and x2 > east)
+                        or (y1 < south and y2 < south)
+                        or (y1 > north and y2 > north)
+                    ):
+                        _edge_cells(x1, y1, x2, y2, lat_range, long_range, cells)
+                    x2, y2 = x1, y1
+        self.borders[grid_key] = cells
+        return cells
+
+    def locate_many(
+        self, points: typing.Iterable[tuple[float, float]]
+    ) -> list[typing.Optional[str]]:
+        return [self.locate(lat, long) for lat, long in points]
+
+
+def _cell(value: float, size: float) -> int:
+    return math.floor(value / size)
+
+
+# Add the cache cells within the given cell ranges that the edge from (x1, y1)
+# to (x2, y2) (longitude, latitude) passes through
+def _edge_cells(
+    x1: float,
+    y1: float,
+    x2: float,
+    y2: float,
+    lat_range: tuple[int, int],
+    long_range: tuple[int, int],
+    cells: set[tuple[int, int]],
+):
+    if x1 > x2:
+        x1, y1, x2, y2 = x2, y2, x1, y1
+    first = max(_cell(x1, CACHE_CELL), long_range[0])
+    last = min(_cell(x2, CACHE_CELL), long_range[1])
+    for long_cell in range(first, last + 1):
+        # Latitudes of the part of the edge within this column of cells
+        if x2 == x1:
+            lat_a, lat_b = y1, y2
+        else:
+            slope = (y2 - y1) / (x2 - x1)
+            start = max(x1, long_cell * CACHE_CELL)
+            end = min(x2, (long_cell + 1) * CACHE_CELL)
+            lat_a = y1 + (start - x1) * slope
+            lat_b = y1 + (end - x1) * slope
+        low = max(_cell(min(lat_a, lat_b), CACHE_CELL), lat_range[0])
+        high = min(_cell(max(lat_a, lat_b), CACHE_CELL), lat_range[1])
+        for lat_cell in range(low, high + 1):
+            cells.add((lat_cell, long_cell))
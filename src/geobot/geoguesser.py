@@ -1,15 +1,23 @@
 import discord
 from discord.ext import commands
+from array import array
+import collections.abc
+import asyncio
+import functools
 import json
 import pathlib
 import io
 import typing
 from geopy import distance
 import os
-import math
 import re
+import uuid
 
 from . import tagbank
+from . import outbox
+from . import replay
+from . import extent
+from . import geocode
 from . import error
 
 OWNER_CHANNEL = 1373110407249657958
@@ -22,9 +30,17 @@ IMAGES_PATH = pathlib.Path(DATA_PATH, "images")
 
 DEFAULT_TRIP = "default"
 
+# Discord's limit on message length
+MAX_MESSAGE = 2000
+
+# Changes that can wait (e.g. recorded message IDs) are saved at most this often
+SAVE_DELAY = 1.0
+
 
 # The information needed to uniquely ID a message
 class MessageID:
+    __slots__ = ("channel_id", "message_id")
+
     channel_id: int
     message_id: int
 
@@ -70,6 +86,14 @@ async def get_channel(
         )
 
 
+# Outbox idempotency key for one message about an image in one channel. Keyed
+# by ImageGame.id, since tags can be reused once an image closes
+def message_key(
+    trip: str, image_id: str, kind: str, channel_id: typing.Union[int, str]
+) -> str:
+    return f"{trip}/{image_id}/{kind}/{channel_id}"
+
+
 def google_maps_url(lat: float, long: float):
     return f"https://www.google.com/maps/search/?api=1&query={lat}%2C{long}"
 
@@ -82,7 +106,35 @@ def print_coord_tuple(lat: float, long: float):
     return f"{lat:.7f}, {long:.7f}"
 
 
+def region_str(region: typing.Optional[str]):
+    return "" if region is None else f" in {region}"
+
+
+# Split content into messages Discord will accept, breaking between lines where
+# possible
+def split_message(content: str, limit: int = MAX_MESSAGE) -> list[str]:
+    parts: list[str] = []
+    current = ""
+    for line in content.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current or not parts:
+        parts.append(current)
+    return parts
+
+
 class Guess:
+    __slots__ = ("latitude", "longitude", "message")
+
     latitude: float
     longitude: float
     message: MessageID
@@ -112,7 +164,67 @@ class Guess:
         )
 
 
+# Read-only guesses of a closed image, stored as parallel columns instead of a
+# Guess and MessageID object per user. Behaves like the dict[int, Guess] it
+# replaces, building Guess objects on access.
+class GuessTable(collections.abc.Mapping):
+    __slots__ = ("users", "latitudes", "longitudes", "channel_ids", "message_ids")
+
+    users: array
+    latitudes: array
+    longitudes: array
+    channel_ids: array
+    message_ids: array
+
+    def __init__(self, guesses: typing.Mapping[int, Guess]):
+        self.users = array("q", guesses.keys())
+        self.latitudes = array("d", (g.latitude for g in guesses.values()))
+        self.longitudes = array("d", (g.longitude for g in guesses.values()))
+        self.channel_ids = array("q", (g.message.channel_id for g in guesses.values()))
+        self.message_ids = array("q", (g.message.message_id for g in guesses.values()))
+
+    def _guess(self, i: int) -> Guess:
+        return Guess(
+            self.latitudes[i],
+            self.longitudes[i],
+            MessageID(channel_id=self.channel_ids[i], message_id=self.message_ids[i]),
+        )
+
+    def __getitem__(self, user: int) -> Guess:
+        try:
+            return self._guess(self.users.index(user))
+        except ValueError:
+            raise KeyError(user)
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(self.users)
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def items(self) -> typing.Iterator[tuple[int, Guess]]:  # type: ignore[override]
+        for i, user in enumerate(self.users):
+            yield user, self._guess(i)
+
+
 class ImageGame:
+    __slots__ = (
+        "id",
+        "filename",
+        "latitude",
+        "longitude",
+        "tag",
+        "trip",
+        "image_messages",
+        "guesshint_messages",
+        "guesses",
+        "maxdist",
+    )
+
+    # Unique across all images ever made. Images from before this existed use
+    # their tag, which keeps the outbox keys of their messages the same
+    id: str
+
     # Image filename
     filename: str
 
@@ -130,8 +242,12 @@ class ImageGame:
     # The messages that say the command for guessing
     guesshint_messages: list[MessageID]
 
-    # Maps users to guesses
-    guesses: dict[int, Guess]
+    # Maps users to guesses. A GuessTable once the image is closed
+    guesses: typing.Union[dict[int, Guess], GuessTable]
+
+    # Map size the guesses were scored with when the image closed. None while
+    # open, and for images closed before this was recorded
+    maxdist: typing.Optional[float]
 
     def __init__(
         self,
@@ -141,20 +257,30 @@ class ImageGame:
         filename: str,
         image_messages: list[MessageID],
         guesshint_messages: list[MessageID],
-        guesses: dict[int, Guess] | None = None,
+        guesses: typing.Optional[typing.Mapping[int, Guess]] = None,
         trip: str | None = None,
+        id: typing.Optional[str] = None,
+        maxdist: typing.Optional[float] = None,
     ):
+        self.id = uuid.uuid4().hex if id is None else id
+        self.maxdist = maxdist
         self.latitude = lat
         self.longitude = long
         self.tag = tag
         self.filename = filename
         self.image_messages = image_messages
         self.guesshint_messages = guesshint_messages
-        self.guesses = {} if guesses is None else guesses
+        self.guesses = {} if guesses is None else guesses  # type: ignore[assignment]
         self.trip = DEFAULT_TRIP if trip is None else trip
 
+    # Compact the guesses once no more can be made
+    def freeze(self):
+        if not isinstance(self.guesses, GuessTable):
+            self.guesses = GuessTable(self.guesses)
+
     def as_ser(self) -> dict:
         return {
+            "id": self.id,
             "filename": self.filename,
             "latitude": self.latitude,
             "longitude": self.longitude,
@@ -163,6 +289,7 @@ class ImageGame:
             "guesshint_messages": [m.as_ser() for m in self.guesshint_messages],
             "guesses": {user: guess.as_ser() for user, guess in self.guesses.items()},
             "trip": self.trip,
+            "maxdist": self.maxdist,
         }
 
     @classmethod
@@ -181,11 +308,24 @@ class ImageGame:
                 for user, guess in ser["guesses"].items()
             },
             trip=ser.get("trip"),
+            id=ser.get("id", ser["tag"]),
+            maxdist=ser.get("maxdist"),
         )
 
 
 # A collection of images (e.g. my Norway trip)
 class Trip:
+    __slots__ = (
+        "id",
+        "images",
+        "closed_images",
+        "owners",
+        "subscribed",
+        "extent",
+        "next_tag",
+        "archived",
+    )
+
     # Unique ID. Can contain letters, numbers, and dashes
     id: str
 
@@ -201,6 +341,15 @@ class Trip:
     # Channels subscribed to this trip
     subscribed: set[int]
 
+    # Tracks the largest distance between any two of this trip's images
+    extent: extent.Diameter
+
+    # Index of the next tag to generate for this trip
+    next_tag: int
+
+    # Archived trips have no open images and can't be selected
+    archived: bool
+
     def __init__(
         self,
         id: str = DEFAULT_TRIP,
@@ -208,12 +357,37 @@ class Trip:
         closed_images: typing.Optional[list[ImageGame]] = None,
         owners: typing.Optional[list[int]] = None,
         subscribed: typing.Optional[set[int]] = None,
+        next_tag: int = 0,
+        archived: bool = False,
+        diameter: typing.Optional[dict] = None,
     ):
         self.id = id
         self.images = {} if images is None else images
         self.closed_images = [] if closed_images is None else closed_images
+        for img in self.closed_images:
+            img.freeze()
         self.owners = [] if owners is None else owners
         self.subscribed = set() if subscribed is None else subscribed
+        self.next_tag = next_tag
+        self.archived = archived
+
+        # `diameter` is a saved Diameter, so loading doesn't recompute it
+        self.extent = extent.Diameter.from_points(
+            (
+                (img.latitude, img.longitude)
+                for img in self.closed_images + list(self.images.values())
+            ),
+            diameter,
+        )
+
+    # Largest distance on this trip's map, or 0 if it has fewer than two images
+    @property
+    def maxdist(self) -> float:
+        return self.extent.diameter
+
+    def add_image(self, image: ImageGame):
+        self.images[image.tag] = image
+        self.extent.add(image.latitude, image.longitude)
 
     def as_ser(self) -> dict:
         return {
@@ -222,6 +396,9 @@ class Trip:
             "closed_images": [img.as_ser() for img in self.closed_images],
             "owners": self.owners,
             "subscribed": list(self.subscribed),
+            "next_tag": self.next_tag,
+            "archived": self.archived,
+            "extent": self.extent.as_ser(),
         }
 
     @classmethod
@@ -232,6 +409,9 @@ class Trip:
             closed_images=[ImageGame.from_ser(s) for s in ser["closed_images"]],
             owners=[int(u) for u in ser["owners"]],
             subscribed=set(ser["subscribed"]),
+            next_tag=ser.get("next_tag", 0),
+            archived=ser.get("archived", False),
+            diameter=ser.get("extent"),
         )
 
 
@@ -257,8 +437,38 @@ class Geoguesser:
     # Maps player IDs to their currently selected trip
     selected_trips: dict[int, str]
 
-    def __init__(self, bot):
-        self.bot = bot
+    # Maps trip IDs to how many of their images had closed at the last score
+    # reset. The current scores come from the images closed after that. None
+    # if the scores were last reset before this was recorded
+    scored_from: typing.Optional[dict[str, int]]
+
+    # Persistent queue of outbound Discord messages
+    outbox: outbox.Outbox
+
+    # Cached distances of closed guesses for re-scoring
+    replay: replay.ReplayEngine
+
+    # Names the regions guesses and answers are in
+    geocoder: geocode.Geocoder
+
+    # Called with the data of every save before it's written (e.g. to replicate
+    # it). May add entries to what's written
+    on_save: typing.Optional[typing.Callable[[dict], None]]
+
+    _save_handle: typing.Optional[asyncio.TimerHandle]
+
+    # Outbound messages go through the bot, or through `deliver` if given
+    def __init__(
+        self,
+        bot: typing.Optional[commands.Bot],
+        deliver: typing.Optional[outbox.Deliver] = None,
+    ):
+        self.bot = bot  # type: ignore[assignment]
+        self.outbox = outbox.Outbox(bot, self.on_delivered, deliver=deliver)
+        self.replay = replay.ReplayEngine()
+        self.geocoder = geocode.Geocoder()
+        self.on_save = None
+        self._save_handle = None
 
         try:
             self.load()
@@ -269,9 +479,20 @@ class Geoguesser:
             self.maxdist = WORLD_MAXDIST
             self.trips = {}
             self.selected_trips = {}
+            self.scored_from = {}
 
         self.tag_bank = tagbank.TagBank()
 
+    # Start sending outbound messages through a bot, e.g. after a standby takes
+    # over
+    def attach(self, bot: commands.Bot):
+        self.bot = bot
+        self.outbox.deliver = functools.partial(outbox.deliver_with_bot, bot)
+        try:
+            self.outbox.load()
+        except FileNotFoundError:
+            pass
+
     def subscribe(self, id):
         self.subscribed.add(id)
         self.save()
@@ -294,65 +515,92 @@ class Geoguesser:
         self.trips[trip].subscribed.remove(channel)
         self.save()
 
-    def save(self):
-        data = {
+    def as_ser(self) -> dict:
+        return {
             "subscribed": list(self.subscribed),
             "admins": list(self.admins),
             "scores": self.scores,
             "maxdist": self.maxdist,
             "trips": {id: trip.as_ser() for id, trip in self.trips.items()},
             "selected_trips": self.selected_trips,
+            "scored_from": self.scored_from,
         }
+
+    def save(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        data = self.as_ser()
+        if self.on_save is not None:
+            self.on_save(data)
         with open(JSON_PATH, "w+") as f:
             json.dump(data, f, indent=4)
 
-    def load(self):
-        with open(JSON_PATH) as f:
-            data: dict = json.load(f)
-            self.subscribed = set(data["subscribed"])
-            self.admins = set(data["admins"])
-            self.scores = {int(k): v for k, v in data["scores"].items()}
-            self.maxdist = data["maxdist"]
-            self.trips = {
-                id: Trip.from_ser(trip) for id, trip in data.get("trips", {}).items()
-            } or {DEFAULT_TRIP: Trip()}
-            self.selected_trips = {
-                int(k): v for k, v in data.get("selected_trips", {}).items()
-            } or {}
-
-            # Backwards compatibility
-            if "images" in data:
-                for tag, image in data["images"].items():
-                    self.trips[DEFAULT_TRIP].images[tag] = ImageGame.from_ser(image)
-            if "closed_images" in data:
-                for image in data["closed_images"]:
-                    self.trips[DEFAULT_TRIP].closed_images.append(
-                        ImageGame.from_ser(image)
-                    )
-
-    async def message_trip_subscribers(
-        self, id, *send_args, **send_kwargs
-    ) -> list[discord.Message]:
-        return await self.message_channels(
-            self.trips[id].subscribed, *send_args, **send_kwargs
-        )
-
-    async def message_subscribers(
-        self, *send_args, **send_kwargs
-    ) -> list[discord.Message]:
-        return await self.message_channels(self.subscribed, *send_args, **send_kwargs)
+    # Save within SAVE_DELAY, along with any other changes made until then.
+    # Saves right away outside the event loop
+    def save_soon(self):
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self._save_handle = loop.call_later(SAVE_DELAY, self.save)
 
-    async def message_admins(self, *send_args, **send_kwargs) -> list[discord.Message]:
-        return await self.message_channels(self.admins, *send_args, **send_kwargs)
+    # Write any changes still waiting for save_soon
+    def flush(self):
+        if self._save_handle is not None:
+            self.save()
 
-    async def message_channels(
-        self, channels: typing.Iterable[int], *send_args, **send_kwargs
-    ) -> list[discord.Message]:
-        messages: list[discord.Message] = []
-        for id in channels:
-            channel = await get_channel(self.bot, id)
-            messages.append(await channel.send(*send_args, **send_kwargs))
-        return messages
+    def load(self):
+        with open(JSON_PATH) as f:
+            self.load_ser(json.load(f))
+
+    def load_ser(self, data: dict):
+        self.subscribed = set(data["subscribed"])
+        self.admins = set(data["admins"])
+        self.scores = {int(k): v for k, v in data["scores"].items()}
+        self.maxdist = data["maxdist"]
+        self.trips = {
+            id: Trip.from_ser(trip) for id, trip in data.get("trips", {}).items()
+        } or {DEFAULT_TRIP: Trip()}
+        self.selected_trips = {
+            int(k): v for k, v in data.get("selected_trips", {}).items()
+        } or {}
+        self.scored_from = data.get("scored_from")
+
+        # Backwards compatibility
+        if "images" in data:
+            for tag, image in data["images"].items():
+                self.trips[DEFAULT_TRIP].add_image(ImageGame.from_ser(image))
+        if "closed_images" in data:
+            for image in data["closed_images"]:
+                closed = ImageGame.from_ser(image)
+                closed.freeze()
+                self.trips[DEFAULT_TRIP].closed_images.append(closed)
+                self.trips[DEFAULT_TRIP].extent.add(closed.latitude, closed.longitude)
+
+    def message_trip_subscribers(self, id, content: str) -> list[str]:
+        return self.message_channels(self.trips[id].subscribed, content)
+
+    def message_subscribers(self, content: str) -> list[str]:
+        return self.message_channels(self.subscribed, content)
+
+    def message_admins(self, content: str) -> list[str]:
+        return self.message_channels(self.admins, content)
+
+    # Queue a message to each channel. Returns the outbox keys of the sends
+    def message_channels(
+        self, channels: typing.Iterable[int], content: str
+    ) -> list[str]:
+        broadcast = uuid.uuid4().hex
+        keys = [
+            self.outbox.send(f"broadcast/{broadcast}/{id}", id, content, skip_save=True)
+            for id in channels
+        ]
+        self.outbox.save()
+        return keys
 
     async def new_trip(self, id: str, player: int):
         if not id or not re.search("^[a-zA-Z0-9\\-]+$", id):
@@ -369,6 +617,8 @@ class Geoguesser:
     async def select_trip(self, player: int, id: str, skip_save: bool = False):
         if id not in self.trips:
             raise error.UnknownTripId(id)
+        if self.trips[id].archived:
+            raise error.TripArchived(id)
         self.selected_trips[player] = id
         if not skip_save:
             self.save()
@@ -399,51 +649,55 @@ class Geoguesser:
         with open(pathlib.Path(trip_path, filename), "wb+") as f:
             f.write(image_bytes.getbuffer())
 
-        messages: list[discord.Message] = []
-        for id in self.trips[trip].subscribed:
-            channel = await get_channel(self.bot, id)
-            image_bytes.seek(0)
-            messages.append(
-                await channel.send(
-                    content=f"# New image to guess:\n### Image tag: `{real_tag}`",
-                    file=discord.File(image_bytes, filename),
-                )
-            )
-        image_messages: list[MessageID] = [
-            MessageID(message=message) for message in messages
-        ]
-
-        guess_command = f"/geo guess {real_tag} <lat> <long>"
-        guesshint_messages = await self.message_trip_subscribers(
-            trip,
-            content=f"### To guess, run `{guess_command}`\nSubmissions are **open**! 🟩",
-        )
-        guesshint_messages = [
-            MessageID(message=message) for message in guesshint_messages
-        ]
-
         img = ImageGame(
             latitude,
             longitude,
             real_tag,
             filename,
-            image_messages,
-            guesshint_messages,
+            [],
+            [],
             trip=trip,
         )
-        self.trips[trip].images[real_tag] = img
+        self.trips[trip].add_image(img)
 
+        guess_command = f"/geo guess {real_tag} <lat> <long>"
+        for id in self.trips[trip].subscribed:
+            image_key = self.outbox.send(
+                message_key(trip, img.id, "image", id),
+                id,
+                f"# New image to guess:\n### Image tag: `{real_tag}`",
+                file=str(pathlib.Path(trip_path, filename)),
+                target={"trip": trip, "image": img.id, "field": "image_messages"},
+                skip_save=True,
+            )
+            self.outbox.send(
+                message_key(trip, img.id, "guesshint", id),
+                id,
+                f"### To guess, run `{guess_command}`\nSubmissions are **open**! 🟩",
+                target={"trip": trip, "image": img.id, "field": "guesshint_messages"},
+                depends=image_key,
+                skip_save=True,
+            )
+
+        self.outbox.save()
         self.save()
 
         return real_tag
 
+    # Tags are handed out in order, skipping any already taken by hand
     def generate_tag(self, trip: str) -> str:
-        return self.tag_bank.get_tag(self.trips[trip].images)
+        t = self.trips[trip]
+        for _ in range(tagbank.MAX_SELECT_ITERATIONS):
+            tag = self.tag_bank.get_tag(trip, t.next_tag)
+            t.next_tag += 1
+            if tag not in t.images:
+                return tag
+        raise error.TagSelectFailure()
 
     def new_guess(
-        self, message: discord.Message, tag: str, lat: float, long: float
+        self, player: int, message: MessageID, tag: str, lat: float, long: float
     ) -> Guess:
-        trip = self.trips[self.get_selected_trip(message.author.id, require_owner=True)]
+        trip = self.trips[self.get_selected_trip(player, require_owner=True)]
 
         if tag not in trip.images:
             raise error.UnknownTag(tag, trip.images.keys())
@@ -451,53 +705,267 @@ class Geoguesser:
 
         dist = distance.distance((lat, long), (image.latitude, image.longitude)).meters
 
-        guess = Guess(lat, long, MessageID(message=message))
-        image.guesses[message.author.id] = guess
+        guess = Guess(lat, long, message)
+        image.guesses[player] = guess
 
         self.save()
 
         return guess
 
-    async def close_image(self, tag: str):
-        if tag not in self.images:
-            raise error.UnknownTag(tag, self.images.keys())
-        image = self.images.pop(tag)
-        self.closed_images.append(image)
-
-        for msg in image.guesshint_messages:
-            message = await msg.get_message(self.bot)
-            await message.edit(content="Submissions are **closed**! 🟥")
+    # The messages of an image of a given kind, both delivered and still queued.
+    # Yields (channel ID, message ID, outbox key); exactly one of the last two is set.
+    def image_message_targets(
+        self, image: ImageGame, kind: str
+    ) -> list[tuple[int, typing.Optional[int], typing.Optional[str]]]:
+        delivered = (
+            image.image_messages if kind == "image" else image.guesshint_messages
+        )
+        targets: list[tuple[int, typing.Optional[int], typing.Optional[str]]] = [
+            (msg.channel_id, msg.message_id, None) for msg in delivered
+        ]
+        prefix = message_key(image.trip, image.id, kind, "")
+        # Deliveries the outbox recorded but the image didn't (e.g. a crash
+        # between the two saves)
+        known = {(msg.channel_id, msg.message_id) for msg in delivered}
+        for channel_id, message_id in self.outbox.delivered_with_prefix(prefix):
+            if (channel_id, message_id) not in known:
+                targets.append((channel_id, message_id, None))
+        for item in self.outbox.pending_with_prefix(prefix):
+            targets.append((item.channel_id, None, item.key))
+        return targets
+
+    def close_image(self, player: int, tag: str):
+        trip = self.trips[self.get_selected_trip(player, require_owner=True)]
+        [(image, results)] = self.close_images(trip, [tag])
 
         result_msg = f"Submissions have closed for tag `{tag}`.\n## Guesses:"
-        for user, guess in image.guesses.items():
-            dist = distance.distance(
-                (guess.latitude, guess.longitude), (image.latitude, image.longitude)
-            )
-            score = self.calc_score(dist.meters)
-            self.add_score(user, score)
-            dist_str = (
-                f"{dist.meters:.1f}m"
-                if dist.meters < 1000
-                else f"{dist.kilometers:.1f}km"
-            )
-            result_msg += f"\n<@{user}> guessed {google_maps_linked_url(guess.latitude, guess.longitude)} ({dist_str}, score +{score})."
+        result_msg += "".join(f"\n{line}" for line in results)
+        parts = split_message(result_msg)
+        for channel_id, message_id, depends in self.image_message_targets(
+            image, "image"
+        ):
+            key = message_key(trip.id, image.id, "results", channel_id)
+            for i, part in enumerate(parts):
+                # Later parts follow the first, replying to it if the image
+                # message isn't known yet
+                depends = self.outbox.reply(
+                    key if i == 0 else f"{key}/{i}",
+                    channel_id,
+                    part,
+                    message_id=message_id,
+                    depends=depends,
+                    skip_save=True,
+                )
 
-        result_msg += f"\n### The actual location was {google_maps_linked_url(image.latitude, image.longitude)}."
+        self.outbox.save()
+        self.save()
 
-        for msg in image.image_messages:
-            message = await msg.get_message(self.bot)
-            await message.reply(result_msg)
+    # Close every open image of the player's selected trip at once. Instead of a
+    # reply to each image, each channel subscribed to the trip gets one summary.
+    # Returns the closed tags.
+    def close_all(self, player: int) -> list[str]:
+        trip = self.trips[self.get_selected_trip(player, require_owner=True)]
+        tags = self._close_all(trip, f"All images of trip `{trip.id}` have closed.")
+        self.outbox.save()
+        self.save()
+        return tags
 
+    # Close every open image of a trip and stop it from being used again.
+    # Returns the closed tags.
+    def archive_trip(self, player: int, id: str) -> list[str]:
+        if id not in self.trips:
+            raise error.UnknownTripId(id)
+        trip = self.trips[id]
+        if player not in trip.owners:
+            raise error.NotTripOwner(id)
+        if trip.archived:
+            raise error.TripArchived(id)
+
+        tags = self._close_all(trip, f"Trip `{id}` has ended.")
+        trip.archived = True
+        self.selected_trips = {
+            p: selected for p, selected in self.selected_trips.items() if selected != id
+        }
+
+        self.outbox.save()
         self.save()
+        return tags
+
+    # Doesn't save
+    def _close_all(self, trip: Trip, heading: str) -> list[str]:
+        scores = dict(self.scores)
+        closed = self.close_images(trip, list(trip.images))
+        if len(closed) == 0:
+            return []
+
+        summary = f"# {heading}"
+        for image, results in closed:
+            summary += f"\n## Tag `{image.tag}`"
+            summary += "".join(f"\n{line}" for line in results)
+        gained = {
+            user: score - scores.get(user, 0)
+            for user, score in self.scores.items()
+            if score != scores.get(user, 0)
+        }
+        if gained:
+            summary += "\n## Points from these images:"
+            for user, points in sorted(gained.items(), key=lambda g: -g[1]):
+                summary += f"\n<@{user}>: +{points}"
+
+        summary_id = uuid.uuid4().hex
+        for channel_id in trip.subscribed:
+            depends = None
+            for i, part in enumerate(split_message(summary)):
+                depends = self.outbox.send(
+                    f"summary/{summary_id}/{channel_id}/{i}",
+                    channel_id,
+                    part,
+                    depends=depends,
+                    skip_save=True,
+                )
+        return [image.tag for image, _ in closed]
+
+    # Close some of a trip's open images together, without saving: score every
+    # guess, geocode them in one batch, and queue the edits marking each image's
+    # submissions closed. Returns each image with the lines describing its
+    # results.
+    def close_images(
+        self, trip: Trip, tags: list[str]
+    ) -> list[tuple[ImageGame, list[str]]]:
+        for tag in tags:
+            if tag not in trip.images:
+                raise error.UnknownTag(tag, trip.images.keys())
+        images = [trip.images.pop(tag) for tag in tags]
+        maxdist = self.trip_maxdist(trip.id)
+        for image in images:
+            image.freeze()
+            image.maxdist = maxdist
+            trip.closed_images.append(image)
+
+        points: list[tuple[float, float]] = []
+        for image in images:
+            points.extend((g.latitude, g.longitude) for g in image.guesses.values())
+            points.append((image.latitude, image.longitude))
+        regions = iter(self.geocoder.locate_many(points))
+
+        closed = []
+        for image in images:
+            for channel_id, message_id, depends in self.image_message_targets(
+                image, "guesshint"
+            ):
+                self.outbox.edit(
+                    message_key(trip.id, image.id, "closehint", channel_id),
+                    channel_id,
+                    "Submissions are **closed**! 🟥",
+                    message_id=message_id,
+                    depends=depends,
+                    skip_save=True,
+                )
 
-        os.remove(pathlib.Path(IMAGES_PATH, image.filename))
+            results = []
+            for user, guess in image.guesses.items():
+                meters = extent.geodesic_distance(
+                    guess.latitude, guess.longitude, image.latitude, image.longitude
+                )
+                score = self.calc_score(meters, maxdist)
+                self.add_score(user, score)
+                dist_str = (
+                    f"{meters:.1f}m" if meters < 1000 else f"{meters / 1000:.1f}km"
+                )
+                results.append(
+                    f"<@{user}> guessed {google_maps_linked_url(guess.latitude, guess.longitude)}{region_str(next(regions))} ({dist_str}, score +{score})."
+                )
+            results.append(
+                f"### The actual location was {google_maps_linked_url(image.latitude, image.longitude)}{region_str(next(regions))}."
+            )
+            closed.append((image, results))
+
+            self.outbox.release_file(
+                str(pathlib.Path(IMAGES_PATH, trip.id, image.filename)),
+                skip_save=True,
+            )
+        return closed
+
+    # Record a confirmed delivery on the image it belongs to. Saved with the next
+    # batch: until then image_message_targets finds it in the outbox
+    def on_delivered(self, item: outbox.OutboxItem, channel_id: int, message_id: int):
+        if item.target is None or item.target.get("trip") not in self.trips:
+            return
+        trip = self.trips[item.target["trip"]]
+        # Targets queued before images had IDs name the tag instead
+        if "image" in item.target:
+            id = item.target["image"]
+            image = next((img for img in trip.images.values() if img.id == id), None)
+        else:
+            image = trip.images.get(item.target["tag"])
+            id = item.target["tag"]
+        if image is None:
+            image = next((img for img in trip.closed_images if img.id == id), None)
+        if image is None:
+            return
+        msg = MessageID(channel_id=channel_id, message_id=message_id)
+        if item.target["field"] == "image_messages":
+            image.image_messages.append(msg)
+        elif item.target["field"] == "guesshint_messages":
+            image.guesshint_messages.append(msg)
+        self.save_soon()
+
+    def calc_score(
+        self, distance: float, maxdist: typing.Optional[float] = None
+    ) -> int:
+        return replay.exp_score(distance, self.maxdist if maxdist is None else maxdist)
+
+    # The trip's own map size, falling back to the global one until the trip
+    # has two distinct image locations
+    def trip_maxdist(self, trip: str) -> float:
+        return self.trips[trip].maxdist or self.maxdist
+
+    # How the current scores would change if the guesses closed since the last
+    # reset had been scored with the global maxdist set to new_maxdist. Trips
+    # with their own map size are only affected if all_trips is set. Without a
+    # recorded reset, every closed guess is re-scored.
+    def preview_maxdist(
+        self, new_maxdist: float, all_trips: bool = False
+    ) -> list[replay.ScoreDiff]:
+        return self.replay.diff(
+            self.trips,
+            self.scores,
+            # Only used for images closed before their maxdist was recorded
+            {id: self.trip_maxdist(id) for id in self.trips},
+            new_maxdist,
+            since=self.scored_from,
+            keep=None if all_trips else set(self.fixed_map_trips()),
+        )
 
-    def calc_score(self, distance: float) -> int:
-        return round(5000 * math.exp(-10 * distance / self.maxdist))
+    # Whether the current scores are known to come from the guesses
+    # preview_maxdist re-scores: either the last reset was recorded, or the
+    # scores match all closed guesses as they were scored. Call after
+    # preview_maxdist
+    def preview_is_exact(self) -> bool:
+        if self.scored_from is not None:
+            return True
+        awarded = self.replay.totals(
+            self.replay.awarded_maxdists(
+                {id: self.trip_maxdist(id) for id in self.trips}
+            )
+        )
+        return {u: s for u, s in awarded.items() if s} == {
+            u: s for u, s in self.scores.items() if s
+        }
 
-    async def reset_scores(self):
+    # Trips with closed images whose own map size a global maxdist doesn't
+    # change
+    def fixed_map_trips(self) -> list[str]:
+        return [
+            id for id, trip in self.trips.items() if trip.maxdist and trip.closed_images
+        ]
+
+    def reset_scores(self):
         self.scores = {}
-        await self.message_subscribers("Scores have been reset.")
+        self.scored_from = {
+            id: len(trip.closed_images) for id, trip in self.trips.items()
+        }
+        self.message_subscribers("Scores have been reset.")
         self.save()
 
     def add_score(self, user: int, score: int):
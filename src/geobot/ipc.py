@@ -0,0 +1,187 @@
+import asyncio
+import json
+import struct
+import typing
+import itertools
+
+from . import error
+
+# Frame layout: a big-endian uint32 length of the rest of the frame, a uint32
+# length of the JSON header, the header, then any binary blobs, each prefixed
+# with its uint32 length. Bytes arguments and results are sent as blobs and
+# referenced from the header as {"$blob": index}, so images don't go through
+# JSON.
+#
+# Headers are {"id", "method", "args"} for requests and {"id", "result"} or
+# {"id", "error": {"type", "args", "attrs"}} for responses. Either side can send
+# requests.
+LENGTH = struct.Struct(">I")
+MAX_FRAME = 64 * 1024 * 1024
+
+Handler = typing.Callable[..., typing.Awaitable[typing.Any]]
+
+
+def _encode(value, blobs: list[bytes]):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        blobs.append(bytes(value))
+        return {"$blob": len(blobs) - 1}
+    if isinstance(value, dict):
+        return {k: _encode(v, blobs) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v, blobs) for v in value]
+    return value
+
+
+def _decode(value, blobs: list[bytes]):
+    if isinstance(value, dict):
+        if len(value) == 1 and "$blob" in value:
+            return blobs[value["$blob"]]
+        return {k: _decode(v, blobs) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v, blobs) for v in value]
+    return value
+
+
+def pack(message: dict) -> bytes:
+    blobs: list[bytes] = []
+    header = json.dumps(
+        _encode(message, blobs), separators=(",", ":"), default=list
+    ).encode()
+    parts = [LENGTH.pack(len(header)), header]
+    for blob in blobs:
+        parts.append(LENGTH.pack(len(blob)))
+        parts.append(blob)
+    body = b"".join(parts)
+    return LENGTH.pack(len(body)) + body
+
+
+def unpack(body: bytes) -> dict:
+    (header_len,) = LENGTH.unpack_from(body, 0)
+    header = json.loads(body[4 : 4 + header_len])
+    blobs = []
+    pos = 4 + header_len
+    while pos < len(body):
+        (blob_len,) = LENGTH.unpack_from(body, pos)
+        blobs.append(body[pos + 4 : pos + 4 + blob_len])
+        pos += 4 + blob_len
+    return _decode(header, blobs)
+
+
+def error_to_wire(e: BaseException) -> dict:
+    return {
+        "type": type(e).__name__,
+        "args": [str(a) for a in e.args],
+        "attrs": {k: v for k, v in vars(e).items() if not k.startswith("_")},
+    }
+
+
+# Rebuild exceptions from the error module so handle_error treats them the
+# same as local ones
+def error_from_wire(wire: dict) -> Exception:
+    cls = getattr(error, wire["type"], None)
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        return error.RemoteError(wire["type"], *wire["args"])
+    e = cls.__new__(cls)
+    Exception.__init__(e, *wire["args"])
+    e.__dict__.update(wire["attrs"])
+    return e
+
+
+# One end of a connection. Sends requests and answers the other end's requests
+# with `handlers`.
+class Connection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    handlers: dict[str, Handler]
+
+    _pending: dict[int, asyncio.Future]
+    _ids: typing.Iterator[int]
+    _read_task: typing.Optional[asyncio.Task]
+    # Requests being answered. The event loop only keeps weak references to
+    # tasks, so these would otherwise be collectable mid-request
+    _answering: set[asyncio.Task]
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        handlers: typing.Optional[dict[str, Handler]] = None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.handlers = {} if handlers is None else handlers
+        self._pending = {}
+        self._ids = itertools.count()
+        self._read_task = None
+        self._answering = set()
+
+    def start(self):
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    @property
+    def closed(self) -> bool:
+        return self._read_task is None or self._read_task.done()
+
+    async def wait_closed(self):
+        if self._read_task is not None:
+            await asyncio.gather(self._read_task, return_exceptions=True)
+
+    def close(self):
+        self.writer.close()
+        if self._read_task is not None:
+            self._read_task.cancel()
+
+    async def request(self, method: str, *args) -> typing.Any:
+        if self.closed:
+            raise ConnectionError("IPC connection is closed")
+        id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[id] = future
+        try:
+            self.writer.write(pack({"id": id, "method": method, "args": list(args)}))
+            await self.writer.drain()
+            return await future
+        finally:
+            self._pending.pop(id, None)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                (length,) = LENGTH.unpack(await self.reader.readexactly(4))
+                if length > MAX_FRAME:
+                    raise ConnectionError(f"IPC frame of {length} bytes is too large")
+                message = unpack(await self.reader.readexactly(length))
+                if "method" in message:
+                    task = asyncio.create_task(self._answer(message))
+                    self._answering.add(task)
+                    task.add_done_callback(self._answering.discard)
+                else:
+                    future = self._pending.get(message["id"])
+                    if future is None or future.done():
+                        continue
+                    if "error" in message:
+                        future.set_exception(error_from_wire(message["error"]))
+                    else:
+                        future.set_result(message.get("result"))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("IPC connection lost"))
+            self.writer.close()
+
+    async def _answer(self, message: dict):
+        id = message["id"]
+        handler = self.handlers.get(message["method"])
+        try:
+            if handler is None:
+                raise error.RemoteError("UnknownMethod", message["method"])
+            response = {"id": id, "result": await handler(*message["args"])}
+        except Exception as e:
+            response = {"id": id, "error": error_to_wire(e)}
+        try:
+            self.writer.write(pack(response))
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
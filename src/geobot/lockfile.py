@@ -0,0 +1,50 @@
+import fcntl
+import os
+import typing
+
+
+# An exclusive lock on a file, held until released or the process exits (even
+# if it's killed), so a crashed holder never leaves it stuck
+class LockFile:
+    path: os.PathLike
+
+    _fd: typing.Optional[int]
+
+    def __init__(self, path: os.PathLike):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    # Returns False if another process holds the lock
+    def acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Note who holds it, for whoever finds it locked
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    # PID written by the current holder, if any
+    def holder(self) -> typing.Optional[int]:
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
@@ -0,0 +1,447 @@
+import discord
+from discord.ext import commands
+import aiohttp
+import asyncio
+import functools
+import json
+import pathlib
+import random
+import typing
+import os
+
+from . import error
+
+PARENT_PATH = pathlib.Path(__file__).parent
+DATA_PATH = pathlib.Path(PARENT_PATH, "data")
+OUTBOX_PATH = pathlib.Path(DATA_PATH, "outbox.json")
+
+NUM_WORKERS = 4
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+# Delay before re-checking an item whose dependency hasn't been delivered yet
+BLOCKED_DELAY = 0.5
+# Number of delivered keys remembered for idempotency and dependency lookup
+MAX_DELIVERED = 10000
+# Deliveries are saved at most this often, so a burst of them is written once
+SAVE_DELAY = 1.0
+
+SEND = "send"
+EDIT = "edit"
+REPLY = "reply"
+
+
+# A single outbound Discord operation waiting to be delivered
+class OutboxItem:
+    # Idempotency key. Enqueuing a key that is pending or delivered is a no-op
+    key: str
+
+    # One of SEND, EDIT or REPLY
+    action: str
+
+    channel_id: int
+    content: str
+
+    # Message to edit or reply to. Either this or depends is set for EDIT/REPLY
+    message_id: typing.Optional[int]
+
+    # Key of an earlier item. This item waits until that item is delivered, and
+    # edits/replies to the message it produced if message_id is unset
+    depends: typing.Optional[str]
+
+    # Path of a file to attach
+    file: typing.Optional[str]
+
+    # Opaque data handed back to the delivery callback
+    target: typing.Optional[dict]
+
+    # Delete the attached file once this item is done
+    remove_file: bool
+
+    attempts: int
+
+    def __init__(
+        self,
+        key: str,
+        action: str,
+        channel_id: int,
+        content: str,
+        message_id: typing.Optional[int] = None,
+        depends: typing.Optional[str] = None,
+        file: typing.Optional[str] = None,
+        target: typing.Optional[dict] = None,
+        remove_file: bool = False,
+        attempts: int = 0,
+    ):
+        self.key = key
+        self.action = action
+        self.channel_id = channel_id
+        self.content = content
+        self.message_id = message_id
+        self.depends = depends
+        self.file = file
+        self.target = target
+        self.remove_file = remove_file
+        self.attempts = attempts
+
+    def as_ser(self) -> dict:
+        return {
+            "key": self.key,
+            "action": self.action,
+            "channel": self.channel_id,
+            "content": self.content,
+            "message": self.message_id,
+            "depends": self.depends,
+            "file": self.file,
+            "target": self.target,
+            "remove_file": self.remove_file,
+            "attempts": self.attempts,
+        }
+
+    @classmethod
+    def from_ser(cls, ser: dict) -> typing.Self:
+        return cls(
+            key=ser["key"],
+            action=ser["action"],
+            channel_id=ser["channel"],
+            content=ser["content"],
+            message_id=ser.get("message"),
+            depends=ser.get("depends"),
+            file=ser.get("file"),
+            target=ser.get("target"),
+            remove_file=ser.get("remove_file", False),
+            attempts=ser.get("attempts", 0),
+        )
+
+
+# Called with the delivered item and the (channel ID, message ID) it produced
+DeliveryCallback = typing.Callable[[OutboxItem, int, int], None]
+
+# Performs an item's Discord operation, given the message to edit or reply to.
+# Returns the (channel ID, message ID) it produced. Raises error.Undeliverable
+# if retrying can't help, error.DeliveryFailed if it might, and
+# error.DeliveryPaused if nothing can be delivered until Outbox.resume().
+Deliver = typing.Callable[
+    [OutboxItem, typing.Optional[int]], typing.Awaitable[tuple[int, int]]
+]
+
+
+async def deliver_with_bot(
+    bot: commands.Bot, item: OutboxItem, message_id: typing.Optional[int]
+) -> tuple[int, int]:
+    try:
+        message = await _deliver(bot, item, message_id)
+    except (discord.Forbidden, discord.NotFound, TypeError) as e:
+        raise error.Undeliverable(str(e))
+    except discord.HTTPException as e:
+        # Other client errors (e.g. content too long) fail the same way every
+        # time. Rate limits and server errors may not
+        if 400 <= e.status < 500 and e.status != 429:
+            raise error.Undeliverable(str(e))
+        raise error.DeliveryFailed(str(e))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise error.DeliveryFailed(str(e))
+    return message.channel.id, message.id
+
+
+async def _deliver(
+    bot: commands.Bot, item: OutboxItem, message_id: typing.Optional[int]
+) -> discord.Message:
+    # Bulk closes queue many items per channel, so skip the fetch when the
+    # channel is cached
+    channel = bot.get_channel(item.channel_id) or await bot.fetch_channel(
+        item.channel_id
+    )
+    if not isinstance(channel, (discord.TextChannel, discord.DMChannel)):
+        raise TypeError(
+            f"Channel {item.channel_id} is not a TextChannel or DMChannel (is {type(channel)})"
+        )
+    if item.action == SEND:
+        if item.file is not None:
+            file = discord.File(item.file, pathlib.Path(item.file).name)
+            return await channel.send(content=item.content, file=file)
+        return await channel.send(content=item.content)
+
+    assert message_id is not None
+    partial = channel.get_partial_message(message_id)
+    if item.action == EDIT:
+        return await partial.edit(content=item.content)
+    elif item.action == REPLY:
+        return await partial.reply(item.content)
+    raise ValueError(f"Unknown outbox action {item.action}")
+
+
+# Persistent queue of outbound messages, drained concurrently with retries
+class Outbox:
+    deliver: Deliver
+    path: os.PathLike
+
+    # Items not yet delivered, in enqueue order
+    pending: dict[str, OutboxItem]
+
+    # Maps delivered keys to the (channel ID, message ID) they produced
+    delivered: dict[str, tuple[int, int]]
+
+    on_delivered: typing.Optional[DeliveryCallback]
+
+    _queue: typing.Optional[asyncio.Queue]
+    _workers: list[asyncio.Task]
+    # Keys waiting for resume()
+    _paused: list[str]
+    _save_handle: typing.Optional[asyncio.TimerHandle]
+
+    # Items are delivered through the bot, or through `deliver` if given (e.g. when
+    # the bot is in another process)
+    def __init__(
+        self,
+        bot: typing.Optional[commands.Bot],
+        on_delivered: typing.Optional[DeliveryCallback] = None,
+        path: typing.Optional[os.PathLike] = None,
+        deliver: typing.Optional[Deliver] = None,
+    ):
+        if deliver is None:
+            assert bot is not None
+            deliver = functools.partial(deliver_with_bot, bot)
+        self.deliver = deliver
+        self.on_delivered = on_delivered
+        self.path = OUTBOX_PATH if path is None else path
+        self._queue = None
+        self._workers = []
+        self._paused = []
+        self._save_handle = None
+
+        try:
+            self.load()
+        except FileNotFoundError:
+            self.pending = {}
+            self.delivered = {}
+
+    def save(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        data = {
+            "pending": [item.as_ser() for item in self.pending.values()],
+            "delivered": {k: list(v) for k, v in self.delivered.items()},
+        }
+        with open(self.path, "w+") as f:
+            json.dump(data, f, indent=4)
+
+    # Save within SAVE_DELAY, along with any other changes made until then.
+    # Saves right away outside the event loop
+    def save_soon(self):
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self._save_handle = loop.call_later(SAVE_DELAY, self.save)
+
+    # Write any changes still waiting for save_soon
+    def flush(self):
+        if self._save_handle is not None:
+            self.save()
+
+    def load(self):
+        with open(self.path) as f:
+            data: dict = json.load(f)
+            items = [OutboxItem.from_ser(s) for s in data["pending"]]
+            self.pending = {item.key: item for item in items}
+            self.delivered = {k: (v[0], v[1]) for k, v in data["delivered"].items()}
+
+    # Start the delivery workers. Must be called from within the event loop
+    def start(self, workers: int = NUM_WORKERS):
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._paused = []
+        for key in self.pending:
+            self._queue.put_nowait(key)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(workers)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        self.flush()
+
+    # Retry the items held back by error.DeliveryPaused, e.g. once a gateway
+    # connects
+    def resume(self):
+        paused, self._paused = self._paused, []
+        for key in paused:
+            self._requeue(key)
+
+    def enqueue(self, item: OutboxItem, skip_save: bool = False) -> str:
+        if item.key in self.pending or item.key in self.delivered:
+            return item.key
+        self.pending[item.key] = item
+        if not skip_save:
+            self.save()
+        if self._queue is not None:
+            self._queue.put_nowait(item.key)
+        return item.key
+
+    def send(
+        self,
+        key: str,
+        channel_id: int,
+        content: str,
+        file: typing.Optional[str] = None,
+        target: typing.Optional[dict] = None,
+        depends: typing.Optional[str] = None,
+        skip_save: bool = False,
+    ) -> str:
+        return self.enqueue(
+            OutboxItem(
+                key,
+                SEND,
+                channel_id,
+                content,
+                depends=depends,
+                file=file,
+                target=target,
+            ),
+            skip_save=skip_save,
+        )
+
+    def edit(
+        self,
+        key: str,
+        channel_id: int,
+        content: str,
+        message_id: typing.Optional[int] = None,
+        depends: typing.Optional[str] = None,
+        skip_save: bool = False,
+    ) -> str:
+        return self.enqueue(
+            OutboxItem(
+                key, EDIT, channel_id, content, message_id=message_id, depends=depends
+            ),
+            skip_save=skip_save,
+        )
+
+    def reply(
+        self,
+        key: str,
+        channel_id: int,
+        content: str,
+        message_id: typing.Optional[int] = None,
+        depends: typing.Optional[str] = None,
+        skip_save: bool = False,
+    ) -> str:
+        return self.enqueue(
+            OutboxItem(
+                key, REPLY, channel_id, content, message_id=message_id, depends=depends
+            ),
+            skip_save=skip_save,
+        )
+
+    def pending_with_prefix(self, prefix: str) -> list[OutboxItem]:
+        return [item for key, item in self.pending.items() if key.startswith(prefix)]
+
+    # (channel ID, message ID) of each delivered item whose key has the prefix
+    def delivered_with_prefix(self, prefix: str) -> list[tuple[int, int]]:
+        return [
+            result for key, result in self.delivered.items() if key.startswith(prefix)
+        ]
+
+    # Delete a file once no pending item still needs to attach it
+    def release_file(self, path: str, skip_save: bool = False):
+        users = [item for item in self.pending.values() if item.file == path]
+        if len(users) == 0:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        for item in users:
+            item.remove_file = True
+        if not skip_save:
+            self.save()
+
+    async def _worker(self):
+        assert self._queue is not None
+        while True:
+            key = await self._queue.get()
+            try:
+                await self._process(key)
+            except Exception:
+                error.logger.exception(f"Unexpected error delivering outbox item {key}")
+            finally:
+                self._queue.task_done()
+
+    def _retry_later(self, key: str, delay: float):
+        asyncio.get_running_loop().call_later(delay, self._requeue, key)
+
+    def _requeue(self, key: str):
+        if self._queue is not None and key in self.pending:
+            self._queue.put_nowait(key)
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _process(self, key: str):
+        item = self.pending.get(key)
+        if item is None:
+            return
+
+        message_id = item.message_id
+        if item.depends is not None:
+            if item.depends in self.pending:
+                self._retry_later(key, BLOCKED_DELAY)
+                return
+            if item.depends not in self.delivered:
+                error.logger.warning(
+                    f"Dropping outbox item {key}: dependency {item.depends} was never delivered"
+                )
+                self._finish(item)
+                return
+            if message_id is None:
+                message_id = self.delivered[item.depends][1]
+
+        try:
+            result = await self.deliver(item, message_id)
+        except error.Undeliverable as e:
+            error.logger.warning(f"Dropping outbox item {key}: {e}")
+            self._finish(item)
+            return
+        except error.DeliveryPaused:
+            self._paused.append(key)
+            return
+        except (error.DeliveryFailed, ConnectionError) as e:
+            item.attempts += 1
+            if item.attempts >= MAX_ATTEMPTS:
+                error.logger.warning(
+                    f"Dropping outbox item {key} after {item.attempts} attempts: {e}"
+                )
+                self._finish(item)
+            else:
+                self.save_soon()
+                self._retry_later(key, self._backoff(item.attempts))
+            return
+
+        self._finish(item, result)
+
+    def _finish(
+        self, item: OutboxItem, result: typing.Optional[tuple[int, int]] = None
+    ):
+        self.pending.pop(item.key, None)
+        if result is not None:
+            self.delivered[item.key] = result
+            while len(self.delivered) > MAX_DELIVERED:
+                del self.delivered[next(iter(self.delivered))]
+        if item.remove_file and item.file is not None:
+            if not any(other.file == item.file for other in self.pending.values()):
+                try:
+                    os.remove(item.file)
+                except FileNotFoundError:
+                    pass
+        if result is not None and self.on_delivered is not None:
+            self.on_delivered(item, *result)
+        self.save_soon()
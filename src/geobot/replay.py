@@ -0,0 +1,193 @@
+from array import array
+import typing
+import math
+
+from . import extent
+
+# Maps a guess distance (meters) and a map size (meters) to a score
+ScoreFunction = typing.Callable[[float, float], int]
+
+# A single map size, or a map size per trip ID
+MaxDist = typing.Union[float, dict[str, float]]
+
+
+def exp_score(dist: float, maxdist: float) -> int:
+    return round(5000 * math.exp(-10 * dist / maxdist))
+
+
+# How a user's total changes when history is re-scored
+class ScoreDiff:
+    user: int
+    old: int
+    new: int
+
+    def __init__(self, user: int, old: int, new: int):
+        self.user = user
+        self.old = old
+        self.new = new
+
+    @property
+    def change(self) -> int:
+        return self.new - self.old
+
+
+# Re-scores every closed guess under candidate scoring parameters.
+#
+# Geodesic distances are the expensive part of scoring and don't depend on the
+# scoring parameters, so they're computed once per guess and kept in flat
+# columns. Replaying is then a single pass over those columns.
+class ReplayEngine:
+    # User of each closed guess
+    users: array
+    # Distance (meters) of each closed guess from the true location
+    distances: array
+    # Index into trip_ids of the trip of each closed guess
+    trip_indices: array
+    # Index of each closed guess's image in its trip's closed images
+    positions: array
+    # Map size each closed guess was scored with, or NaN if it wasn't recorded
+    awarded: array
+
+    trip_ids: list[str]
+
+    # Number of closed images of each trip already added to the columns
+    seen: dict[str, int]
+
+    def __init__(self):
+        self.users = array("q")
+        self.distances = array("d")
+        self.trip_indices = array("q")
+        self.positions = array("q")
+        self.awarded = array("d")
+        self.trip_ids = []
+        self.seen = {}
+
+    # Add guesses from images closed since the last update. Closed image lists
+    # only ever grow, so only the tail of each needs to be read. Can warm the
+    # cache from a worker thread, but only one update may run at a time.
+    def update(self, trips: dict):
+        for id, trip in list(trips.items()):
+            if id not in self.seen:
+                self.seen[id] = 0
+                self.trip_ids.append(id)
+            trip_index = self.trip_ids.index(id)
+            start = self.seen[id]
+            end = len(trip.closed_images)
+            for position in range(start, end):
+                image = trip.closed_images[position]
+                awarded = math.nan if image.maxdist is None else image.maxdist
+                for user, guess in list(image.guesses.items()):
+                    self.users.append(user)
+                    self.trip_indices.append(trip_index)
+                    self.positions.append(position)
+                    self.awarded.append(awarded)
+                    self.distances.append(
+                        extent.geodesic_distance(
+                            guess.latitude,
+                            guess.longitude,
+                            image.latitude,
+                            image.longitude,
+                        )
+                    )
+            self.seen[id] = end
+
+    # Map size of each closed guess when it was scored, or from `fallback` for
+    # images closed before that was recorded
+    def awarded_maxdists(self, fallback: MaxDist) -> array:
+        if isinstance(fallback, dict):
+            per_trip = [fallback[id] for id in self.trip_ids]
+            return array(
+                "d",
+                [
+                    per_trip[t] if math.isnan(m) else m
+                    for m, t in zip(self.awarded, self.trip_indices)
+                ],
+            )
+        return array("d", [fallback if math.isnan(m) else m for m in self.awarded])
+
+    def _per_guess(self, maxdist: MaxDist) -> list[float]:
+        if isinstance(maxdist, dict):
+            per_trip = [maxdist[id] for id in self.trip_ids]
+            return [per_trip[i] for i in self.trip_indices]
+        return [maxdist] * len(self.distances)
+
+    # Score of each closed guess. `maxdist` can also give a map size per guess
+    def scores(
+        self,
+        maxdist: typing.Union[MaxDist, array],
+        score_fn: ScoreFunction = exp_score,
+    ) -> array:
+        maxdists = maxdist if isinstance(maxdist, array) else self._per_guess(maxdist)
+        if score_fn is exp_score:
+            # Inline the default formula to skip a function call per guess
+            exp = math.exp
+            return array(
+                "q",
+                [
+                    round(5000 * exp(-10 * d / m))
+                    for d, m in zip(self.distances, maxdists)
+                ],
+            )
+        return array("q", [score_fn(d, m) for d, m in zip(self.distances, maxdists)])
+
+    # Total score per user. With `since`, only guesses on images closed after
+    # that many of their trip's images count
+    def totals(
+        self,
+        maxdist: typing.Union[MaxDist, array],
+        score_fn: ScoreFunction = exp_score,
+        since: typing.Optional[dict[str, int]] = None,
+    ) -> dict[int, int]:
+        firsts = [0 if since is None else since.get(id, 0) for id in self.trip_ids]
+        totals: dict[int, int] = {}
+        for user, trip_index, position, score in zip(
+            self.users,
+            self.trip_indices,
+            self.positions,
+            self.scores(maxdist, score_fn),
+        ):
+            if position >= firsts[trip_index]:
+                totals[user] = totals.get(user, 0) + score
+        return totals
+
+    # Compare current scores with what they would be had the counted guesses
+    # been scored with candidate parameters instead of the ones they were
+    # awarded with. Guesses on trips in `keep` keep their awarded map size.
+    # Sorted by new total, highest first.
+    def diff(
+        self,
+        trips: dict,
+        current: dict[int, int],
+        fallback_maxdist: MaxDist,
+        new_maxdist: MaxDist,
+        since: typing.Optional[dict[str, int]] = None,
+        keep: typing.Optional[set[str]] = None,
+        score_fn: ScoreFunction = exp_score,
+        new_score_fn: typing.Optional[ScoreFunction] = None,
+    ) -> list[ScoreDiff]:
+        self.update(trips)
+        awarded_maxdists = self.awarded_maxdists(fallback_maxdist)
+        kept = [keep is not None and id in keep for id in self.trip_ids]
+        new_maxdists = array(
+            "d",
+            [
+                a if kept[t] else n
+                for a, n, t in zip(
+                    awarded_maxdists, self._per_guess(new_maxdist), self.trip_indices
+                )
+            ],
+        )
+        awarded = self.totals(awarded_maxdists, score_fn, since)
+        rescored = self.totals(
+            new_maxdists, score_fn if new_score_fn is None else new_score_fn, since
+        )
+        diffs = [
+            ScoreDiff(
+                user,
+                current.get(user, 0),
+                current.get(user, 0) + rescored.get(user, 0) - awarded.get(user, 0),
+            )
+            for user in current.keys() | rescored.keys()
+        ]
+        diffs.sort(key=lambda d: d.new, reverse=True)
+        return diffs
@@ -0,0 +1,531 @@
+import asyncio
+import collections
+import json
+import pathlib
+import sys
+import time
+import typing
+import uuid
+import os
+
+from . import geoguesser
+from . import outbox
+from . import ipc
+from . import error
+from . import lockfile
+
+PARENT_PATH = pathlib.Path(__file__).parent
+DATA_PATH = pathlib.Path(PARENT_PATH, "data")
+STANDBY_SOCKET_PATH = pathlib.Path(DATA_PATH, "standby.sock")
+# Held by whichever process owns the game state and talks to Discord: the bot,
+# its engine process, or a standby that has taken over
+ACTIVE_LOCK_PATH = pathlib.Path(DATA_PATH, "active.lock")
+
+# How often the primary tries to reach a standby that isn't listening
+RECONNECT_INTERVAL = 1.0
+# How long the standby waits for a lost primary to come back before taking over
+TAKEOVER_GRACE = 3.0
+# Most deltas buffered for the standby; past this the next connection resyncs
+# with a snapshot instead
+MAX_BACKLOG = 1000
+# Number of recent acknowledgements the lag statistics cover
+LAG_HISTORY = 100
+
+# Top-level entries of Geoguesser.as_ser() other than trips. Each is sent whole
+# whenever it changes.
+SECTIONS = [
+    "subscribed",
+    "admins",
+    "scores",
+    "maxdist",
+    "selected_trips",
+    "scored_from",
+]
+
+
+# Compare saved states by their JSON text, as they would be written to disk
+def _fingerprint(value) -> str:
+    return json.dumps(value, separators=(",", ":"))
+
+
+# Trip fields other than its images
+def _trip_meta(trip: geoguesser.Trip) -> dict:
+    return {
+        "owners": trip.owners,
+        "subscribed": list(trip.subscribed),
+        "next_tag": trip.next_tag,
+        "archived": trip.archived,
+    }
+
+
+# Closed images only change when a delivery is recorded on them
+def _closed_key(image: geoguesser.ImageGame) -> tuple[str, int, int]:
+    return (image.id, len(image.image_messages), len(image.guesshint_messages))
+
+
+# What the standby was last sent of one trip. Open images are few, so they're
+# compared by their JSON; closed images are compared by _closed_key, so a save
+# costs no serialization for images that didn't change.
+class TripState:
+    __slots__ = ("meta", "open", "closed")
+
+    meta: str
+    # Maps open tags to (image ID, fingerprint)
+    open: dict[str, tuple[str, str]]
+    closed: list[tuple[str, int, int]]
+
+    def __init__(self, trip: geoguesser.Trip):
+        self.meta = _fingerprint(_trip_meta(trip))
+        self.open = {
+            tag: (image.id, _fingerprint(image.as_ser()))
+            for tag, image in trip.images.items()
+        }
+        self.closed = [_closed_key(image) for image in trip.closed_images]
+
+    # The changes to a trip since the last call, or None. Each image that
+    # changed is sent whole; nothing else is.
+    def diff(self, trip: geoguesser.Trip) -> typing.Optional[dict]:
+        delta: dict = {}
+
+        meta = _trip_meta(trip)
+        fingerprint = _fingerprint(meta)
+        if fingerprint != self.meta:
+            self.meta = fingerprint
+            delta["meta"] = meta
+
+        closed = {}
+        for i, image in enumerate(trip.closed_images):
+            key = _closed_key(image)
+            if i >= len(self.closed):
+                self.closed.append(key)
+            elif self.closed[i] == key:
+                continue
+            else:
+                self.closed[i] = key
+            closed[i] = image.as_ser()
+        if closed:
+            delta["closed"] = closed
+
+        removed = [
+            tag
+            for tag, (id, _) in self.open.items()
+            if tag not in trip.images or trip.images[tag].id != id
+        ]
+        for tag in removed:
+            del self.open[tag]
+        if removed:
+            delta["removed_open"] = removed
+
+        opened = {}
+        for tag, image in trip.images.items():
+            ser = image.as_ser()
+            state = (image.id, _fingerprint(ser))
+            if self.open.get(tag) != state:
+                self.open[tag] = state
+                opened[tag] = ser
+        if opened:
+            delta["open"] = opened
+
+        return delta or None
+
+
+# Streams game state from the primary to a standby process. The first message on
+# each connection is a snapshot of the whole state; after that, every save sends
+# a delta holding the top-level sections and the images that changed. Each
+# message carries a sequence number and the time it was published, so both
+# ends can tell how far behind the standby is.
+#
+# Each save also records, under "replication", the epoch and the sequence
+# number a standby has once it has everything in that save. The primary saves
+# before the standby has its changes, so on takeover the standby uses the
+# saved state instead of its own copy if that's newer.
+class Replicator:
+    geo: geoguesser.Geoguesser
+    socket_path: os.PathLike
+
+    # Identifies this primary's run, since sequence numbers restart with it
+    epoch: str
+
+    conn: typing.Optional[ipc.Connection]
+
+    # Sequence number of the last published and last acknowledged message
+    published: int
+    acked: int
+
+    # Seconds from publishing to acknowledgement, and from publishing to being
+    # applied on the standby, for recent messages
+    ack_lags: collections.deque[float]
+    apply_lags: collections.deque[float]
+
+    # What the standby was last sent. _sections is None if it needs a snapshot
+    _sections: typing.Optional[dict[str, str]]
+    _trips: dict[str, TripState]
+
+    _backlog: asyncio.Queue
+    _task: typing.Optional[asyncio.Task]
+
+    def __init__(
+        self,
+        geo: geoguesser.Geoguesser,
+        socket_path: typing.Optional[os.PathLike] = None,
+    ):
+        self.geo = geo
+        self.socket_path = STANDBY_SOCKET_PATH if socket_path is None else socket_path
+        self.epoch = uuid.uuid4().hex
+        self.conn = None
+        self.published = 0
+        self.acked = 0
+        self.ack_lags = collections.deque(maxlen=LAG_HISTORY)
+        self.apply_lags = collections.deque(maxlen=LAG_HISTORY)
+        self._sections = None
+        self._trips = {}
+        self._backlog = asyncio.Queue()
+        self._task = None
+
+    # Must be called from within the event loop
+    def start(self):
+        if self._task is not None:
+            return
+        self.geo.on_save = self.publish
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.geo.on_save == self.publish:
+            self.geo.on_save = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.conn is not None:
+            self.conn.close()
+
+    @property
+    def connected(self) -> bool:
+        return self.conn is not None and not self.conn.closed
+
+    # Called with the state of every Geoguesser.save() before it's written
+    def publish(self, data: dict):
+        if self._sections is None or not self.connected:
+            # The next connection starts from a snapshot anyway, which will be
+            # the next message
+            self._record(data, self.published + 1)
+            return
+        if self._backlog.qsize() >= MAX_BACKLOG:
+            self._resync()
+            self._record(data, self.published + 1)
+            return
+
+        sections = {}
+        for name in SECTIONS:
+            fingerprint = _fingerprint(data[name])
+            if self._sections.get(name) != fingerprint:
+                self._sections[name] = fingerprint
+                sections[name] = data[name]
+        # Trips are diffed from the live objects rather than `data`
+        trips = {}
+        for id, trip in self.geo.trips.items():
+            state = self._trips.get(id)
+            if state is None:
+                self._trips[id] = TripState(trip)
+                trips[id] = {"new": data["trips"][id]}
+                continue
+            delta = state.diff(trip)
+            if delta is not None:
+                trips[id] = delta
+        removed = [id for id in self._trips if id not in self.geo.trips]
+        for id in removed:
+            del self._trips[id]
+
+        if sections or trips or removed:
+            self._backlog.put_nowait(
+                self._message(
+                    "delta",
+                    {"sections": sections, "trips": trips, "removed": removed},
+                )
+            )
+        self._record(data, self.published)
+
+    # Note in the saved state which message brings the standby up to it
+    def _record(self, data: dict, seq: int):
+        data["replication"] = {"epoch": self.epoch, "seq": seq}
+
+    def _message(self, kind: str, body: dict) -> dict:
+        self.published += 1
+        return {
+            "kind": kind,
+            "epoch": self.epoch,
+            "seq": self.published,
+            "time": time.time(),
+            **body,
+        }
+
+    def _snapshot(self) -> dict:
+        data = self.geo.as_ser()
+        self._sections = {name: _fingerprint(data[name]) for name in SECTIONS}
+        self._trips = {id: TripState(trip) for id, trip in self.geo.trips.items()}
+        return self._message(
+            "snapshot",
+            {
+                "sections": {name: data[name] for name in SECTIONS},
+                "trips": data["trips"],
+            },
+        )
+
+    def _resync(self):
+        self._sections = None
+        if self.conn is not None:
+            self.conn.close()
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+
+            self.conn = ipc.Connection(reader, writer)
+            self.conn.start()
+            self._backlog = asyncio.Queue()
+            self._backlog.put_nowait(self._snapshot())
+            try:
+                while True:
+                    await self._send(await self._backlog.get())
+            except Exception as e:
+                error.logger.warning(f"Lost connection to the standby: {e!r}")
+            finally:
+                self._sections = None
+                self.conn.close()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def _send(self, message: dict):
+        assert self.conn is not None
+        ack = await self.conn.request("replicate", message)
+        self.acked = ack["seq"]
+        self.ack_lags.append(time.time() - message["time"])
+        self.apply_lags.append(ack["lag"])
+
+    def status(self) -> dict:
+        return {
+            "connected": self.connected,
+            "published": self.published,
+            "acked": self.acked,
+            "behind": self._backlog.qsize() if self.connected else None,
+            "ack_lag": _lag_stats(self.ack_lags),
+            "apply_lag": _lag_stats(self.apply_lags),
+        }
+
+
+# (last, average, worst) of recent lags in seconds, or None if there are none
+def _lag_stats(lags: typing.Sequence[float]) -> typing.Optional[list[float]]:
+    if len(lags) == 0:
+        return None
+    return [lags[-1], sum(lags) / len(lags), max(lags)]
+
+
+# The standby process: keeps a Geoguesser in sync with the primary's snapshots
+# and deltas without touching the data directory, and takes over once the
+# primary has been gone for TAKEOVER_GRACE seconds and has released the active
+# lock, so a primary that's alive but disconnected is never doubled.
+class StandbyServer:
+    geo: geoguesser.Geoguesser
+    grace: float
+
+    # Acquired on takeover and kept by the bot it becomes
+    active: lockfile.LockFile
+
+    conn: typing.Optional[ipc.Connection]
+
+    # Epoch, sequence number and lag of the last applied message
+    epoch: typing.Optional[str]
+    seq: int
+    lag: typing.Optional[float]
+
+    # Whether a snapshot has been applied, so the copy is worth taking over with
+    synced: bool
+
+    _takeover: asyncio.Event
+    _grace_task: typing.Optional[asyncio.Task]
+
+    def __init__(self, grace: float = TAKEOVER_GRACE):
+        self.geo = geoguesser.Geoguesser(None, deliver=self.deliver)
+        self.grace = grace
+        self.active = lockfile.LockFile(ACTIVE_LOCK_PATH)
+        self.conn = None
+        self.epoch = None
+        self.seq = 0
+        self.lag = None
+        self.synced = False
+        self._takeover = asyncio.Event()
+        self._grace_task = None
+
+    # Nothing is sent until the standby has taken over
+    async def deliver(
+        self, item: outbox.OutboxItem, message_id: typing.Optional[int]
+    ) -> tuple[int, int]:
+        raise ConnectionError("The standby hasn't taken over")
+
+    # Serve the primary until it's gone, then return the up to date game state
+    async def serve(self, socket_path: os.PathLike) -> geoguesser.Geoguesser:
+        lock = lockfile.LockFile(f"{socket_path}.lock")
+        if not lock.acquire():
+            raise error.AlreadyRunning(str(lock.path), lock.holder())
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        server = await asyncio.start_unix_server(self._on_connect, socket_path)
+        try:
+            async with server:
+                await self._takeover.wait()
+        finally:
+            lock.release()
+        if self.conn is not None:
+            self.conn.close()
+        return self.geo
+
+    async def _on_connect(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        if self._grace_task is not None:
+            self._grace_task.cancel()
+            self._grace_task = None
+        if self.conn is not None:
+            self.conn.close()
+        conn = ipc.Connection(reader, writer, {"replicate": self.replicate})
+        self.conn = conn
+        conn.start()
+        await conn.wait_closed()
+        if self.conn is conn and self.synced:
+            error.logger.warning(
+                f"Lost the primary, taking over in {self.grace}s unless it returns"
+            )
+            self._grace_task = asyncio.create_task(self._wait_grace())
+
+    async def _wait_grace(self):
+        await asyncio.sleep(self.grace)
+        if not self.active.acquire():
+            error.logger.warning(
+                f"The primary (PID {self.active.holder()}) still holds {self.active.path}, waiting for it to exit"
+            )
+            while not self.active.acquire():
+                await asyncio.sleep(RECONNECT_INTERVAL)
+        self._takeover.set()
+
+    async def replicate(self, message: dict) -> dict:
+        if message["kind"] == "snapshot":
+            self.geo.load_ser({**message["sections"], "trips": message["trips"]})
+            self.synced = True
+            self.epoch = message["epoch"]
+        elif self.synced:
+            self._apply_sections(message["sections"])
+            for id, delta in message["trips"].items():
+                self._apply_trip(id, delta)
+            for id in message["removed"]:
+                self.geo.trips.pop(id, None)
+        self.seq = message["seq"]
+        self.lag = time.time() - message["time"]
+        return {"seq": self.seq, "lag": self.lag}
+
+    def _apply_trip(self, id: str, delta: dict):
+        if "new" in delta:
+            self.geo.trips[id] = geoguesser.Trip.from_ser(delta["new"])
+            return
+        trip = self.geo.trips[id]
+
+        if "meta" in delta:
+            meta = delta["meta"]
+            trip.owners = [int(u) for u in meta["owners"]]
+            trip.subscribed = set(meta["subscribed"])
+            trip.next_tag = meta["next_tag"]
+            trip.archived = meta["archived"]
+
+        for tag in delta.get("removed_open", []):
+            trip.images.pop(tag, None)
+
+        # Keys are indices, sent as strings. Closing only ever appends
+        for i, ser in sorted(
+            ((int(i), ser) for i, ser in delta.get("closed", {}).items()),
+            key=lambda c: c[0],
+        ):
+            image = geoguesser.ImageGame.from_ser(ser)
+            image.freeze()
+            if i < len(trip.closed_images):
+                trip.closed_images[i] = image
+            elif i == len(trip.closed_images):
+                trip.closed_images.append(image)
+            else:
+                # The primary resyncs with a snapshot when this fails
+                raise ValueError(f"Closed image {i} of trip {id} is out of order")
+
+        for tag, ser in delta.get("open", {}).items():
+            image = geoguesser.ImageGame.from_ser(ser)
+            if tag in trip.images and trip.images[tag].id == image.id:
+                trip.images[tag] = image
+            else:
+                # Includes it in the trip's extent
+                trip.add_image(image)
+
+    # Whether the saved game state has changes this copy doesn't: it was saved
+    # by another primary run, or after the last message applied here. A
+    # missing or unreadable file, or one saved without replication, is never
+    # newer
+    def saved_is_newer(self) -> bool:
+        try:
+            with open(geoguesser.JSON_PATH) as f:
+                saved = json.load(f).get("replication")
+        except (FileNotFoundError, ValueError):
+            return False
+        if saved is None:
+            return False
+        return saved["epoch"] != self.epoch or saved["seq"] > self.seq
+
+    # Same conversions as Geoguesser.load_ser(), for just the sections sent
+    def _apply_sections(self, sections: dict):
+        if "subscribed" in sections:
+            self.geo.subscribed = set(sections["subscribed"])
+        if "admins" in sections:
+            self.geo.admins = set(sections["admins"])
+        if "scores" in sections:
+            self.geo.scores = {int(k): v for k, v in sections["scores"].items()}
+        if "maxdist" in sections:
+            self.geo.maxdist = sections["maxdist"]
+        if "selected_trips" in sections:
+            self.geo.selected_trips = {
+                int(k): v for k, v in sections["selected_trips"].items()
+            }
+        if "scored_from" in sections:
+            self.geo.scored_from = sections["scored_from"]
+
+
+# Run as a standby until taking over, then run the bot with the replicated state
+def run_standby(socket_path: typing.Optional[os.PathLike] = None):
+    # bot imports this module through engine
+    from . import bot
+
+    server = StandbyServer()
+    try:
+        geo = asyncio.run(
+            server.serve(STANDBY_SOCKET_PATH if socket_path is None else socket_path)
+        )
+    except KeyboardInterrupt:
+        return
+    error.logger.warning("Taking over from the primary")
+    if server.saved_is_newer():
+        # The primary saved changes it didn't live to replicate
+        error.logger.warning("The saved game state is newer, taking over with it")
+        geo.load()
+    # Writes the replicated state for the outbox and any later restarts
+    geo.save()
+    bot.start(geo, server.active)
+
+
+def main():
+    try:
+        run_standby(sys.argv[1] if len(sys.argv) > 1 else None)
+    except error.AlreadyRunning as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
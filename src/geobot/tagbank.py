@@ -1,6 +1,9 @@
+from array import array
+import hashlib
 import pathlib
-import random
 import typing
+import mmap
+import math
 import os
 
 from . import error
@@ -10,9 +13,75 @@ DATA_PATH = pathlib.Path(PARENT_PATH, "data")
 WORDS_PATH = pathlib.Path(DATA_PATH, "WORDS.txt")
 MAX_SELECT_ITERATIONS = 1000
 
+# Tags are made of up to this many words
+MAX_WORDS = 3
+SEPARATOR = "-"
+FEISTEL_ROUNDS = 4
 
+
+# A sorted, newline-separated word file, memory-mapped. Only the offset of each
+# line is kept in memory, and words are looked up by binary search.
+class WordList:
+    words_file: os.PathLike
+    offsets: array
+
+    _mm: mmap.mmap
+
+    def __init__(self, words_file: os.PathLike):
+        self.words_file = words_file
+        with open(words_file, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Start of each word, then the end of the last one
+        self.offsets = array("I")
+        pos = 0
+        end = len(self._mm)
+        while pos < end:
+            newline = self._mm.find(b"\n", pos)
+            if newline == -1:
+                newline = end
+            if len(self._mm[pos:newline].strip()) > 0:
+                self.offsets.append(pos)
+                self.offsets.append(newline)
+            pos = newline + 1
+
+        for i in range(1, len(self)):
+            if self._word_bytes(i - 1) >= self._word_bytes(i):
+                raise ValueError(f"{words_file} is not sorted and de-duplicated")
+
+    def __len__(self) -> int:
+        return len(self.offsets) // 2
+
+    def _word_bytes(self, i: int) -> bytes:
+        return self._mm[self.offsets[2 * i] : self.offsets[2 * i + 1]].strip()
+
+    def __getitem__(self, i: int) -> str:
+        return self._word_bytes(i).decode()
+
+    # Index of a word, or None if it's not in the list
+    def index(self, word: str) -> typing.Optional[int]:
+        target = word.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word_bytes(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._word_bytes(lo) == target:
+            return lo
+        return None
+
+
+# Maps integers bijectively onto tags of one to MAX_WORDS words.
+#
+# Tags with fewer words come first: with N words, numbers 0..N-1 are one-word
+# tags, the next N^2 are two-word tags, and so on. Within each tier, numbers
+# are shuffled by a Feistel network keyed by the trip ID, so handing out 0, 1,
+# 2... per trip gives unique, unpredictable tags without remembering which
+# have been used.
 class TagBank:
-    tags: list[str]
+    words: WordList
     words_file: os.PathLike
 
     def __init__(self, words_file: typing.Optional[os.PathLike] = None):
@@ -20,17 +89,80 @@ class TagBank:
         self.load()
 
     def load(self):
-        with open(self.words_file) as f:
-            self.tags = [
-                line.strip() for line in f.readlines() if len(line.strip()) > 0
-            ]
-
-    def get_tag(self, exclude: typing.Optional[typing.Iterable[str]]) -> str:
-        if exclude is None:
-            return random.choice(self.tags)
-        else:
-            for i in range(MAX_SELECT_ITERATIONS):
-                choice = random.choice(self.tags)
-                if choice not in exclude:
-                    return choice
-            raise error.TagSelectFailure()
+        self.words = WordList(self.words_file)
+
+    # Number of distinct tags
+    def __len__(self) -> int:
+        n = len(self.words)
+        return sum(n**k for k in range(1, MAX_WORDS + 1))
+
+    # The `index`th tag of a trip
+    def get_tag(self, trip: str, index: int) -> str:
+        n = len(self.words)
+        for k in range(1, MAX_WORDS + 1):
+            if index < n**k:
+                x = _permute(_trip_key(trip), n**k, index)
+                words = []
+                for _ in range(k):
+                    x, digit = divmod(x, n)
+                    words.append(self.words[digit])
+                return SEPARATOR.join(words)
+            index -= n**k
+        raise error.TagSelectFailure()
+
+    # Inverse of get_tag. None if the string isn't a tag
+    def get_index(self, trip: str, tag: str) -> typing.Optional[int]:
+        parts = tag.split(SEPARATOR)
+        if not 1 <= len(parts) <= MAX_WORDS:
+            return None
+        n = len(self.words)
+        x = 0
+        for word in reversed(parts):
+            digit = self.words.index(word)
+            if digit is None:
+                return None
+            x = x * n + digit
+        k = len(parts)
+        tier_start = sum(n**j for j in range(1, k))
+        return tier_start + _unpermute(_trip_key(trip), n**k, x)
+
+    def is_tag(self, tag: str) -> bool:
+        return self.get_index("", tag) is not None
+
+
+def _trip_key(trip: str) -> bytes:
+    return hashlib.blake2b(trip.encode(), digest_size=16).digest()
+
+
+def _round(key: bytes, round: int, value: int, modulus: int) -> int:
+    digest = hashlib.blake2b(
+        round.to_bytes(1, "little") + value.to_bytes(8, "little"),
+        key=key,
+        digest_size=8,
+    ).digest()
+    return int.from_bytes(digest, "little") % modulus
+
+
+# A permutation of range(size). A balanced Feistel network permutes
+# range(side * side) where side * side >= size, and values that land outside
+# range(size) are re-encrypted until they land inside (cycle walking).
+def _permute(key: bytes, size: int, x: int) -> int:
+    side = math.isqrt(size - 1) + 1
+    while True:
+        left, right = divmod(x, side)
+        for r in range(FEISTEL_ROUNDS):
+            left, right = right, (left + _round(key, r, right, side)) % side
+        x = left * side + right
+        if x < size:
+            return x
+
+
+def _unpermute(key: bytes, size: int, x: int) -> int:
+    side = math.isqrt(size - 1) + 1
+    while True:
+        left, right = divmod(x, side)
+        for r in reversed(range(FEISTEL_ROUNDS)):
+            left, right = (right - _round(key, r, left, side)) % side, left
+        x = left * side + right
+        if x < size:
+            return x
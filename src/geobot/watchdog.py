@@ -0,0 +1,167 @@
+import asyncio
+import collections
+import pathlib
+import threading
+import time
+import types
+import typing
+import sys
+
+from . import error
+
+PACKAGE_PATH = str(pathlib.Path(__file__).parent)
+
+# How often the event loop is checked
+INTERVAL = 0.1
+# Lag (seconds) past which the loop counts as blocked
+THRESHOLD = 0.25
+# Number of recent stalls kept for the summary
+HISTORY = 100
+
+
+# A period during which the event loop was blocked
+class Stall:
+    __slots__ = ("started", "duration", "culprit")
+
+    # Wall-clock time the stall began
+    started: float
+    duration: float
+    # Where the loop was stuck, e.g. "Geoguesser.close_image (in command close_image)"
+    culprit: str
+
+    def __init__(self, started: float, duration: float, culprit: str):
+        self.started = started
+        self.duration = duration
+        self.culprit = culprit
+
+
+# Describe what a stack is doing in terms of geobot code: the outermost
+# Geoguesser method (or else the innermost geobot function), and the bot
+# command it was called from, if any
+def attribute(frame: typing.Optional[types.FrameType]) -> str:
+    innermost = None
+    method = None
+    command = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename.startswith(PACKAGE_PATH) and not code.co_filename.endswith(
+            "watchdog.py"
+        ):
+            if innermost is None:
+                innermost = code.co_qualname
+            if code.co_qualname.startswith("Geoguesser."):
+                method = code.co_qualname
+            # Commands are closures defined in bot.start()
+            if code.co_filename.endswith("bot.py") and code.co_qualname.startswith(
+                "start.<locals>."
+            ):
+                command = code.co_name
+        frame = frame.f_back
+
+    where = method if method is not None else innermost
+    if where is None:
+        return "unknown"
+    if command is None:
+        return where
+    return f"{where} (in command {command})"
+
+
+# Measures event loop lag. A task on the loop notes when it last ran, and a
+# helper thread samples the loop thread's stack whenever that gets too old, so
+# a stall can be blamed on whatever was running during it.
+class Watchdog:
+    interval: float
+    threshold: float
+
+    stalls: collections.deque[Stall]
+
+    _samples: collections.Counter[str]
+    _last_tick: float
+    _loop_thread: typing.Optional[int]
+    _task: typing.Optional[asyncio.Task]
+    _thread: typing.Optional[threading.Thread]
+    _stopped: threading.Event
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        interval: float = INTERVAL,
+        threshold: float = THRESHOLD,
+        history: int = HISTORY,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = collections.deque(maxlen=history)
+        self._samples = collections.Counter()
+        self._last_tick = time.monotonic()
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    # Must be called from within the event loop to watch
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._tick())
+        self._thread = threading.Thread(
+            target=self._sample, name="geobot-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _tick(self):
+        while True:
+            before = time.monotonic()
+            self._last_tick = before
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - before - self.interval
+            if lag > self.threshold:
+                self._record(lag)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval / 2):
+            if time.monotonic() - self._last_tick < self.interval + self.threshold:
+                continue
+            assert self._loop_thread is not None
+            frame = sys._current_frames().get(self._loop_thread)
+            culprit = attribute(frame)
+            del frame
+            with self._lock:
+                self._samples[culprit] += 1
+
+    def _record(self, lag: float):
+        with self._lock:
+            if self._samples:
+                culprit = self._samples.most_common(1)[0][0]
+            else:
+                culprit = "unknown"
+            self._samples.clear()
+            self.stalls.append(Stall(time.time() - lag, lag, culprit))
+        error.logger.warning(f"Event loop blocked for {lag:.2f}s by {culprit}")
+
+    # (culprit, count, total seconds, longest seconds) over recent stalls,
+    # worst total first
+    def summary(self) -> list[tuple[str, int, float, float]]:
+        totals: dict[str, list] = {}
+        with self._lock:
+            stalls = list(self.stalls)
+        for stall in stalls:
+            entry = totals.setdefault(stall.culprit, [stall.culprit, 0, 0.0, 0.0])
+            entry[1] += 1
+            entry[2] += stall.duration
+            entry[3] = max(entry[3], stall.duration)
+        return sorted(
+            (tuple(entry) for entry in totals.values()),  # type: ignore[misc]
+            key=lambda entry: entry[2],
+            reverse=True,
+        )
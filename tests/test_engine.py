@@ -0,0 +1,202 @@
+import asyncio
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from geobot import engine
+from geobot import error
+from geobot import geoguesser
+from geobot import ipc
+from geobot import lockfile
+from geobot import outbox
+from geobot import replication
+
+
+# Keeps game state, images and the outbox in a temporary directory
+class TempDataTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.data_path = pathlib.Path(tmp.name)
+        for target, name in [
+            ("geobot.geoguesser.JSON_PATH", "data.json"),
+            ("geobot.geoguesser.IMAGES_PATH", "images"),
+            ("geobot.outbox.OUTBOX_PATH", "outbox.json"),
+            ("geobot.replication.ACTIVE_LOCK_PATH", "active.lock"),
+        ]:
+            patcher = mock.patch(target, pathlib.Path(self.data_path, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.socket_path = pathlib.Path(self.data_path, "engine.sock")
+
+    async def start_server(self) -> engine.EngineServer:
+        server = engine.EngineServer()
+        task = asyncio.create_task(server.serve(self.socket_path))
+        self.addAsyncCleanup(self._stop_server, server, task)
+        for _ in range(100):
+            if self.socket_path.exists():
+                break
+            await asyncio.sleep(0.01)
+        return server
+
+    async def _stop_server(self, server: engine.EngineServer, task: asyncio.Task):
+        if not task.done():
+            await server.shutdown()
+        await asyncio.wait_for(task, 5)
+
+
+class TestEngineServer(TempDataTestCase):
+    # Stands in for the gateway: answers "deliver" requests itself
+    async def connect_gateway(self, delivered: list) -> ipc.Connection:
+        async def deliver(item: dict, message_id):
+            delivered.append(item)
+            return item["channel"], 1000 + len(delivered)
+
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        conn = ipc.Connection(reader, writer, {"deliver": deliver})
+        conn.start()
+        self.addCleanup(conn.close)
+        return conn
+
+    async def test_operations(self):
+        await self.start_server()
+        conn = await self.connect_gateway([])
+        self.assertTrue(await conn.request("subscribe", 5))
+        self.assertFalse(await conn.request("subscribe", 5))
+        self.assertTrue(await conn.request("is_subscribed", 5))
+        self.assertFalse(await conn.request("is_subscribed", 6))
+
+    async def test_errors_cross_the_socket(self):
+        await self.start_server()
+        conn = await self.connect_gateway([])
+        await conn.request("new_trip", "trip-1", 7)
+        with self.assertRaises(error.DuplicateTripID):
+            await conn.request("new_trip", "trip-1", 7)
+        with self.assertRaises(error.UnknownTag):
+            await conn.request("close_image", 7, "apple")
+
+    async def test_messages_are_delivered_through_the_gateway(self):
+        await self.start_server()
+        delivered: list = []
+        conn = await self.connect_gateway(delivered)
+        await conn.request("subscribe", 5)
+        await conn.request("subscribe", 6)
+        await conn.request("message_subscribers", "hello")
+        for _ in range(100):
+            if len(delivered) == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(sorted(item["channel"] for item in delivered), [5, 6])
+        self.assertTrue(all(item["content"] == "hello" for item in delivered))
+
+    async def test_messages_wait_for_a_gateway(self):
+        server = await self.start_server()
+        box = server.engine.geo.outbox
+        await server.engine.subscribe(5)
+        await server.engine.message_subscribers("hello")
+        await asyncio.sleep(0.1)
+        [item] = box.pending.values()
+        self.assertEqual(item.attempts, 0)
+
+        delivered: list = []
+        await self.connect_gateway(delivered)
+        for _ in range(100):
+            if delivered:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual([item["content"] for item in delivered], ["hello"])
+        self.assertEqual(box.pending, {})
+
+    async def test_second_engine_refuses_to_start(self):
+        await self.start_server()
+        with self.assertRaises(error.AlreadyRunning):
+            await engine.EngineServer().serve(self.socket_path)
+
+    async def test_refuses_to_start_while_another_process_is_active(self):
+        active = lockfile.LockFile(replication.ACTIVE_LOCK_PATH)
+        self.assertTrue(active.acquire())
+        self.addCleanup(active.release)
+        with self.assertRaises(error.AlreadyRunning):
+            await engine.EngineServer().serve(self.socket_path)
+        # The engine's own lock isn't left behind
+        self.assertTrue(lockfile.LockFile(f"{self.socket_path}.lock").acquire())
+
+
+class TestRemoteEngine(TempDataTestCase):
+    async def test_matches_local_engine(self):
+        await self.start_server()
+        remote = engine.RemoteEngine(None, self.socket_path, spawn=False)  # type: ignore[arg-type]
+        await remote.start()
+        self.addAsyncCleanup(remote.stop)
+
+        await remote.new_trip("trip-1", 7)
+        tag = await remote.new_image(7, b"image", "png", 10.0, 20.0, None)
+        self.assertTrue(await remote.is_tag(tag))
+        self.assertEqual(await remote.active_tags(7), [tag])
+        url = await remote.new_guess(7, 5, 9, tag, 11.0, 21.0)
+        self.assertEqual(url, geoguesser.google_maps_linked_url(11.0, 21.0))
+        await remote.close_image(7, tag)
+        self.assertEqual(await remote.active_tags(7), [])
+        self.assertIn("<@7>", await remote.scores_text())
+
+    async def test_adopts_a_running_engine(self):
+        await self.start_server()
+        remote = engine.RemoteEngine(None, self.socket_path, spawn=True)  # type: ignore[arg-type]
+        await remote.start()
+        self.assertIsNone(remote.process)
+        await remote.subscribe(5)
+        self.assertTrue(await remote.is_subscribed(5))
+        await remote.stop()
+
+    async def test_unknown_operation(self):
+        remote = engine.RemoteEngine(None, self.socket_path, spawn=False)  # type: ignore[arg-type]
+        with self.assertRaises(AttributeError):
+            remote.not_an_operation
+
+
+class TestLocalEngine(TempDataTestCase):
+    async def test_subscribe(self):
+        local = engine.Engine(
+            geoguesser.Geoguesser(None, deliver=self._no_deliver)  # type: ignore[arg-type]
+        )
+        self.assertTrue(await local.subscribe(5))
+        self.assertFalse(await local.subscribe(5))
+        self.assertTrue(await local.is_subscribed(5))
+
+    async def closed_game(self) -> engine.Engine:
+        local = engine.Engine(
+            geoguesser.Geoguesser(None, deliver=self._no_deliver)  # type: ignore[arg-type]
+        )
+        await local.start()
+        self.addAsyncCleanup(local.stop)
+        await local.new_trip("trip-1", 7)
+        tag = await local.new_image(7, b"image", "png", 10.0, 20.0, None)
+        await local.new_guess(7, 5, 9, tag, 11.0, 21.0)
+        await local.close_image(7, tag)
+        return local
+
+    async def test_preview_waits_for_warm_up(self):
+        local = await self.closed_game()
+        text = await local.preview_maxdist_text(local.geo.maxdist)
+        self.assertIn("(+0)", text)
+        self.assertNotIn("may not match", text)
+
+    async def test_preview_flags_unrecorded_reset(self):
+        local = await self.closed_game()
+        # As loaded from a game state saved before resets were recorded, after
+        # a reset
+        local.geo.scored_from = None
+        local.geo.scores = {}
+        self.assertIn("may not match", await local.preview_maxdist_text(1e6))
+
+        local.geo.scores = {7: local.geo.replay.totals(local.geo.maxdist)[7]}
+        self.assertNotIn("may not match", await local.preview_maxdist_text(1e6))
+
+    @staticmethod
+    async def _no_deliver(item: outbox.OutboxItem, message_id):
+        raise ConnectionError()
+
+
+if __name__ == "__main__":
+    unittest.main()
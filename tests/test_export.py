@@ -0,0 +1,116 @@
+import io
+import json
+import math
+import unittest
+from unittest import mock
+
+from geobot import export
+from geobot import geoguesser
+
+
+def make_image(tag: str, lat: float, maxdist=None) -> dict:
+    image = geoguesser.ImageGame(
+        lat,
+        lat + 1,
+        tag,
+        f"{tag}.png",
+        [geoguesser.MessageID(channel_id=5, message_id=1 << 40)],
+        [],
+        maxdist=maxdist,
+    )
+    for user in range(3):
+        image.guesses[user + 10] = geoguesser.Guess(
+            lat + user,
+            lat - user,
+            geoguesser.MessageID(channel_id=5, message_id=(1 << 41) + user),
+        )
+    return image.as_ser()
+
+
+def same_rows(a: list[tuple], b: list[tuple]) -> bool:
+    def key(row):
+        return tuple(
+            "nan" if isinstance(v, float) and math.isnan(v) else v for v in row
+        )
+
+    return [key(row) for row in a] == [key(row) for row in b]
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+            "subscribed": [1, 2],
+            "scores": {"10": 5000},
+            "maxdist": 1.5e7,
+            "trips": {
+                "norway": {
+                    "id": "norway",
+                    "images": {"open-one": make_image("open-one", 60.0)},
+                    "closed_images": [
+                        make_image("first", 61.0, maxdist=1e6),
+                        make_image("legacy", 62.0),
+                    ],
+                    "owners": [7],
+                    "subscribed": [],
+                    "next_tag": 3,
+                },
+                "empty": {"id": "empty", "images": {}, "closed_images": []},
+            },
+            "selected_trips": {"7": "norway"},
+        }
+
+    def rows(self, data: dict, read_size: int) -> list[tuple]:
+        with mock.patch("geobot.export.READ_SIZE", read_size):
+            return list(export.iter_rows(io.StringIO(json.dumps(data, indent=4))))
+
+    def test_rows_from_saved_state(self):
+        rows = self.rows(self.data, 1 << 16)
+        self.assertEqual(
+            [(row[0], row[1], row[2], row[3]) for row in rows],
+            [
+                ("norway", tag, status, user)
+                for tag, status in [
+                    ("first", "closed"),
+                    ("legacy", "closed"),
+                    ("open-one", "open"),
+                ]
+                for user in [10, 11, 12]
+            ],
+        )
+        first = rows[0]
+        self.assertEqual(first[9], 1e6)
+        self.assertEqual(first[10], export.replay.exp_score(first[8], 1e6))
+        # Scored before maxdists were recorded, or not scored yet
+        for row in rows[3:]:
+            self.assertTrue(math.isnan(row[9]))
+            self.assertEqual(row[10], export.MISSING_INT)
+
+    # Small reads split keys, strings and numbers across buffer refills
+    def test_rows_dont_depend_on_read_size(self):
+        expected = self.rows(self.data, 1 << 16)
+        for read_size in [1, 3, 7, 64]:
+            with self.subTest(read_size=read_size):
+                self.assertTrue(same_rows(self.rows(self.data, read_size), expected))
+
+    def test_images_from_before_trips(self):
+        data = {
+            "maxdist": 1.5e7,
+            "images": {"open-one": make_image("open-one", 60.0)},
+            "closed_images": [make_image("first", 61.0)],
+        }
+        rows = self.rows(data, 5)
+        self.assertEqual(
+            [(row[0], row[1], row[2]) for row in rows[::3]],
+            [("default", "first", "closed"), ("default", "open-one", "open")],
+        )
+
+    def test_columnar_round_trip(self):
+        rows = self.rows(self.data, 1 << 16)
+        out = io.BytesIO()
+        export.write_columnar(rows, out)
+        out.seek(0)
+        self.assertTrue(same_rows(list(export.read_columnar(out)), rows))
+
+
+if __name__ == "__main__":
+    unittest.main()
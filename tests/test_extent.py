@@ -0,0 +1,100 @@
+import itertools
+import random
+import unittest
+
+from geobot import extent
+
+
+def brute_force(points: list[tuple[float, float]]) -> float:
+    return max(
+        (
+            extent.geodesic_distance(*a, *b)
+            for a, b in itertools.combinations(points, 2)
+        ),
+        default=0.0,
+    )
+
+
+def random_points(
+    rng: random.Random, n: int, center: tuple[float, float], spread: float
+) -> list[tuple[float, float]]:
+    lat, long = center
+    return [
+        (
+            max(-90.0, min(90.0, lat + rng.uniform(-spread, spread))),
+            (long + rng.uniform(-spread, spread) + 180) % 360 - 180,
+        )
+        for _ in range(n)
+    ]
+
+
+class TestDiameter(unittest.TestCase):
+    def assertMatchesBruteForce(self, points: list[tuple[float, float]]):
+        diameter = extent.Diameter.from_points(points)
+        self.assertAlmostEqual(diameter.diameter, brute_force(points), places=3)
+        i, j = diameter.pair
+        self.assertAlmostEqual(
+            extent.geodesic_distance(
+                diameter.lats[i], diameter.longs[i], diameter.lats[j], diameter.longs[j]
+            ),
+            diameter.diameter,
+            places=3,
+        )
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        for center, spread in [
+            ((60.0, 10.0), 2.0),
+            ((0.0, 179.0), 5.0),
+            ((89.0, 0.0), 3.0),
+            ((0.0, 0.0), 180.0),
+        ]:
+            with self.subTest(center=center, spread=spread):
+                self.assertMatchesBruteForce(random_points(rng, 60, center, spread))
+
+    # Near-antipodal points are where geodesic and great-circle distances
+    # disagree the most about which pair is farthest
+    def test_nearly_antipodal_clusters(self):
+        rng = random.Random(2)
+        for lat, long in [(0.0, 0.0), (45.0, 30.0), (80.0, -100.0)]:
+            points = random_points(rng, 30, (lat, long), 1.0) + random_points(
+                rng, 30, (-lat, long + 180), 1.0
+            )
+            rng.shuffle(points)
+            with self.subTest(lat=lat, long=long):
+                self.assertMatchesBruteForce(points)
+
+    def test_fewer_than_two_points(self):
+        self.assertEqual(extent.Diameter().diameter, 0.0)
+        self.assertEqual(extent.Diameter.from_points([(10.0, 20.0)]).diameter, 0.0)
+        self.assertEqual(
+            extent.Diameter.from_points([(10.0, 20.0), (10.0, 20.0)]).diameter, 0.0
+        )
+
+    def test_restores_saved_diameter(self):
+        points = random_points(random.Random(3), 40, (50.0, 5.0), 10.0)
+        saved = extent.Diameter.from_points(points).as_ser()
+
+        # Reordered, as a trip lists its closed images first
+        restored = extent.Diameter.from_points(list(reversed(points)), saved)
+        self.assertEqual(restored.diameter, saved["diameter"])
+        self.assertEqual(restored.as_ser()["diameter"], saved["diameter"])
+        self.assertEqual(
+            sorted(map(tuple, restored.as_ser()["pair"])),
+            sorted(map(tuple, saved["pair"])),
+        )
+
+        # Growing it afterwards still tracks the diameter
+        far = (-50.0, -175.0)
+        restored.add(*far)
+        self.assertAlmostEqual(restored.diameter, brute_force(points + [far]), places=3)
+
+    def test_rebuilds_when_saved_diameter_is_stale(self):
+        points = random_points(random.Random(4), 20, (0.0, 0.0), 20.0)
+        saved = extent.Diameter.from_points(points[:10]).as_ser()
+        rebuilt = extent.Diameter.from_points(points, saved)
+        self.assertAlmostEqual(rebuilt.diameter, brute_force(points), places=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import pathlib
+import unittest
+
+from geobot import geocode
+
+# Two countries split by a slightly diagonal border near longitude 1, an
+# enclave in a hole of the eastern one, and a country of two islands
+REGIONS_PATH = pathlib.Path(pathlib.Path(__file__).parent, "data", "regions.geojson")
+
+
+class TestPolygon(unittest.TestCase):
+    def test_contains(self):
+        square = geocode.Polygon(0, [[[0, 0], [2, 0], [2, 1], [0, 1], [0, 0]]])
+        self.assertTrue(square.contains(0.5, 1.5))
+        self.assertFalse(square.contains(1.5, 1.5))
+        self.assertFalse(square.contains(0.5, -0.1))
+        self.assertFalse(square.contains(0.5, 2.1))
+
+    def test_holes_are_excluded(self):
+        ring = [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]
+        hole = [[1, 1], [3, 1], [3, 3], [1, 3], [1, 1]]
+        donut = geocode.Polygon(0, [ring, hole])
+        self.assertTrue(donut.contains(0.5, 0.5))
+        self.assertFalse(donut.contains(2, 2))
+        self.assertTrue(donut.contains(3.5, 2))
+
+
+class TestGeocoder(unittest.TestCase):
+    def setUp(self):
+        self.geocoder = geocode.Geocoder(REGIONS_PATH)
+
+    def test_loads_named_polygons(self):
+        self.assertEqual(self.geocoder.names, ["West", "East", "Enclave", "Islands"])
+        # One polygon per island
+        self.assertEqual(len(self.geocoder.polygons), 5)
+
+    def test_grid_index(self):
+        west, east = self.geocoder.polygons[0], self.geocoder.polygons[1]
+        west_index = self.geocoder.polygons.index(west)
+        east_index = self.geocoder.polygons.index(east)
+        for cell in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+            self.assertIn(west_index, self.geocoder.grid[cell])
+        self.assertNotIn(west_index, self.geocoder.grid.get((0, 2), []))
+        self.assertIn(east_index, self.geocoder.grid[(0, 2)])
+        self.assertNotIn((5, 5), self.geocoder.grid)
+
+    def test_locate(self):
+        for lat, long, name in [
+            (1.0, 0.5, "West"),
+            (1.5, 2.8, "East"),
+            (0.75, 2.25, "Enclave"),
+            (10.25, 10.25, "Islands"),
+            (-4.75, -19.75, "Islands"),
+            (1.0, 5.0, None),
+            (1.0, 360.5, "West"),
+        ]:
+            with self.subTest(lat=lat, long=long):
+                self.assertEqual(self.geocoder.locate(lat, long), name)
+
+    # Both points are in the same cache cell, on either side of the border, so
+    # whichever is looked up first mustn't decide the other
+    def test_points_near_a_border(self):
+        names = {(1.0, 1.0049): "West", (1.0, 1.0051): "East"}
+        for points in [list(names), list(reversed(names))]:
+            geocoder = geocode.Geocoder(REGIONS_PATH)
+            self.assertEqual(
+                geocoder.locate_many(points * 2), [names[p] for p in points * 2]
+            )
+
+    def test_only_cells_without_borders_are_cached(self):
+        self.geocoder.locate(1.0, 1.0049)
+        self.geocoder.locate(1.0, 0.5)
+        self.assertEqual(list(self.geocoder.cache), [(100, 50)])
+
+    def test_missing_file(self):
+        geocoder = geocode.Geocoder(pathlib.Path(REGIONS_PATH.parent, "missing"))
+        self.assertIsNone(geocoder.locate(1.0, 0.5))
+
+
+class TestBundledRegions(unittest.TestCase):
+    def test_countries(self):
+        geocoder = geocode.Geocoder()
+        self.assertEqual(geocoder.locate(59.91, 10.75), "Norway")
+        self.assertEqual(geocoder.locate(59.33, 18.07), "Sweden")
+        self.assertIsNone(geocoder.locate(0.0, -30.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import asyncio
+import gc
+import socket
+import unittest
+
+from geobot import ipc
+from geobot import error
+
+
+async def connection_pair(
+    left_handlers: dict, right_handlers: dict
+) -> tuple[ipc.Connection, ipc.Connection]:
+    left_sock, right_sock = socket.socketpair()
+    left = ipc.Connection(
+        *await asyncio.open_unix_connection(sock=left_sock), left_handlers
+    )
+    right = ipc.Connection(
+        *await asyncio.open_unix_connection(sock=right_sock), right_handlers
+    )
+    left.start()
+    right.start()
+    return left, right
+
+
+class TestFraming(unittest.TestCase):
+    def test_round_trip(self):
+        message = {"id": 3, "method": "m", "args": [1, "two", None, [3.5], {"k": 4}]}
+        body = ipc.pack(message)
+        (length,) = ipc.LENGTH.unpack_from(body, 0)
+        self.assertEqual(length, len(body) - 4)
+        self.assertEqual(ipc.unpack(body[4:]), message)
+
+    def test_blobs_bypass_json(self):
+        image = bytes(range(256)) * 10
+        body = ipc.pack({"id": 0, "args": [image, {"nested": b"x"}]})
+        (header_len,) = ipc.LENGTH.unpack_from(body, 4)
+        self.assertNotIn(b"\x00\x01\x02", body[8 : 8 + header_len])
+        self.assertEqual(
+            ipc.unpack(body[4:]), {"id": 0, "args": [image, {"nested": b"x"}]}
+        )
+
+
+class TestErrors(unittest.TestCase):
+    def test_error_module_exceptions_are_rebuilt(self):
+        wire = ipc.error_to_wire(error.UnknownTag("apple", ["pear"]))
+        rebuilt = ipc.error_from_wire(wire)
+        self.assertIsInstance(rebuilt, error.UnknownTag)
+        self.assertEqual(rebuilt.tag, "apple")
+        self.assertEqual(rebuilt.available_tags, ["pear"])
+
+    def test_other_exceptions_become_remote_errors(self):
+        rebuilt = ipc.error_from_wire(ipc.error_to_wire(KeyError("missing")))
+        self.assertIsInstance(rebuilt, error.RemoteError)
+        self.assertEqual(rebuilt.type, "KeyError")
+
+
+class TestConnection(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_both_ways(self):
+        async def add(a, b):
+            return a + b
+
+        async def echo(data):
+            return data
+
+        left, right = await connection_pair({"echo": echo}, {"add": add})
+        self.assertEqual(await left.request("add", 2, 3), 5)
+        self.assertEqual(await right.request("echo", b"\x00bytes"), b"\x00bytes")
+        left.close()
+        right.close()
+
+    async def test_concurrent_requests(self):
+        async def slow(delay, value):
+            await asyncio.sleep(delay)
+            return value
+
+        left, right = await connection_pair({}, {"slow": slow})
+        results = await asyncio.gather(
+            left.request("slow", 0.05, "first"), left.request("slow", 0, "second")
+        )
+        self.assertEqual(results, ["first", "second"])
+        left.close()
+        right.close()
+
+    async def test_handler_errors_are_raised_by_caller(self):
+        async def close(tag):
+            raise error.UnknownTag(tag, [])
+
+        left, right = await connection_pair({}, {"close": close})
+        with self.assertRaises(error.UnknownTag) as cm:
+            await left.request("close", "apple")
+        self.assertEqual(cm.exception.tag, "apple")
+        with self.assertRaises(error.RemoteError):
+            await left.request("missing")
+        left.close()
+        right.close()
+
+    async def test_handlers_are_kept_alive_until_answered(self):
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        left, right = await connection_pair({}, {"slow": slow})
+        request = asyncio.create_task(left.request("slow"))
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(right._answering), 1)
+        gc.collect()
+        self.assertEqual(await request, "done")
+        self.assertEqual(right._answering, set())
+        left.close()
+        right.close()
+
+    async def test_pending_requests_fail_when_peer_goes_away(self):
+        async def hang():
+            await asyncio.sleep(60)
+
+        left, right = await connection_pair({}, {"hang": hang})
+        request = asyncio.create_task(left.request("hang"))
+        await asyncio.sleep(0.05)
+        right.close()
+        with self.assertRaises(ConnectionError):
+            await request
+        await left.wait_closed()
+        self.assertTrue(left.closed)
+        with self.assertRaises(ConnectionError):
+            await left.request("hang")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+import asyncio
+import pathlib
+import tempfile
+import typing
+import unittest
+from unittest import mock
+
+from geobot import error
+from geobot import outbox
+
+
+# Records each delivery, failing the ones `fail` says to
+class FakeDiscord:
+    def __init__(self):
+        self.delivered: list[tuple[str, typing.Optional[int]]] = []
+        self.calls: dict[str, int] = {}
+        self.fail: dict[str, Exception] = {}
+        self.next_message = 100
+
+    async def deliver(
+        self, item: outbox.OutboxItem, message_id: typing.Optional[int]
+    ) -> tuple[int, int]:
+        self.calls[item.key] = self.calls.get(item.key, 0) + 1
+        if item.key in self.fail:
+            raise self.fail[item.key]
+        self.delivered.append((item.key, message_id))
+        self.next_message += 1
+        return item.channel_id, self.next_message
+
+
+class TestOutbox(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = pathlib.Path(tmp.name, "outbox.json")
+        self.discord = FakeDiscord()
+        self.recorded: list[tuple[str, int, int]] = []
+        for target, value in [
+            ("geobot.outbox.BACKOFF_BASE", 0.001),
+            ("geobot.outbox.BLOCKED_DELAY", 0.001),
+            ("geobot.outbox.SAVE_DELAY", 0.01),
+        ]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def new_outbox(self) -> outbox.Outbox:
+        box = outbox.Outbox(
+            None,
+            on_delivered=lambda item, channel, message: self.recorded.append(
+                (item.key, channel, message)
+            ),
+            path=self.path,
+            deliver=self.discord.deliver,
+        )
+        self.addAsyncCleanup(box.stop)
+        return box
+
+    async def drained(self, box: outbox.Outbox):
+        for _ in range(500):
+            if not box.pending:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f"Items still pending: {list(box.pending)}")
+
+    async def test_dependents_use_the_message_they_depend_on(self):
+        box = self.new_outbox()
+        box.start()
+        image = box.send("image", 5, "image")
+        box.edit("hint", 5, "closed", depends=image)
+        box.reply("result", 5, "result", depends=image)
+        await self.drained(box)
+
+        self.assertEqual(self.discord.delivered[0], ("image", None))
+        image_message = box.delivered["image"][1]
+        self.assertEqual(
+            sorted(self.discord.delivered[1:]),
+            [("hint", image_message), ("result", image_message)],
+        )
+        self.assertEqual([key for key, _, _ in self.recorded][0], "image")
+
+    async def test_enqueue_is_idempotent(self):
+        box = self.new_outbox()
+        box.start()
+        box.send("a", 5, "first")
+        box.send("a", 5, "again")
+        await self.drained(box)
+        box.send("a", 5, "after delivery")
+        await self.drained(box)
+        self.assertEqual(self.discord.calls, {"a": 1})
+
+    async def test_retries_until_delivered(self):
+        box = self.new_outbox()
+        self.discord.fail["a"] = error.DeliveryFailed("rate limited")
+        box.start()
+        box.send("a", 5, "content")
+        for _ in range(100):
+            if self.discord.calls.get("a", 0) >= 3:
+                break
+            await asyncio.sleep(0.01)
+        del self.discord.fail["a"]
+        await self.drained(box)
+        self.assertIn("a", box.delivered)
+        self.assertGreaterEqual(self.discord.calls["a"], 4)
+
+    async def test_gives_up_after_max_attempts(self):
+        box = self.new_outbox()
+        self.discord.fail["a"] = error.DeliveryFailed("server error")
+        box.start()
+        box.send("a", 5, "content")
+        await self.drained(box)
+        self.assertEqual(self.discord.calls["a"], outbox.MAX_ATTEMPTS)
+        self.assertNotIn("a", box.delivered)
+
+    async def test_paused_items_wait_without_using_attempts(self):
+        box = self.new_outbox()
+        self.discord.fail["a"] = error.DeliveryPaused("no gateway")
+        box.start()
+        box.send("a", 5, "content")
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.discord.calls["a"], 1)
+        self.assertEqual(box.pending["a"].attempts, 0)
+
+        del self.discord.fail["a"]
+        box.resume()
+        await self.drained(box)
+        self.assertIn("a", box.delivered)
+
+    async def test_undeliverable_drops_item_and_dependents(self):
+        box = self.new_outbox()
+        self.discord.fail["image"] = error.Undeliverable("missing access")
+        box.start()
+        image = box.send("image", 5, "image")
+        box.edit("hint", 5, "closed", depends=image)
+        box.send("other", 6, "other")
+        await self.drained(box)
+
+        self.assertEqual(self.discord.calls["image"], 1)
+        self.assertNotIn("hint", self.discord.calls)
+        self.assertEqual([key for key, _ in self.discord.delivered], ["other"])
+
+    async def test_resumes_after_restart(self):
+        box = self.new_outbox()
+        image = box.send("image", 5, "image")
+        box.edit("hint", 5, "closed", depends=image)
+
+        restarted = self.new_outbox()
+        self.assertEqual(list(restarted.pending), ["image", "hint"])
+        restarted.start()
+        await self.drained(restarted)
+        self.assertEqual([key for key, _ in self.discord.delivered], ["image", "hint"])
+
+    async def test_deliveries_are_saved_in_batches(self):
+        box = self.new_outbox()
+        for i in range(20):
+            box.send(f"m{i}", 5, "content", skip_save=True)
+        box.save()
+        with mock.patch.object(box, "save", wraps=box.save) as save:
+            box.start()
+            await self.drained(box)
+            await asyncio.sleep(outbox.SAVE_DELAY * 5)
+            self.assertLess(save.call_count, 5)
+
+        restarted = self.new_outbox()
+        self.assertEqual(restarted.pending, {})
+        self.assertEqual(len(restarted.delivered), 20)
+
+    async def test_stop_writes_unsaved_deliveries(self):
+        box = self.new_outbox()
+        box.send("a", 5, "content")
+        box.start()
+        await self.drained(box)
+        await box.stop()
+        self.assertIn("a", self.new_outbox().delivered)
+
+    async def test_file_removed_once_no_item_needs_it(self):
+        file = pathlib.Path(self.path.parent, "image.png")
+        file.write_bytes(b"x")
+        box = self.new_outbox()
+        box.send("a", 5, "image", file=str(file))
+        box.send("b", 6, "image", file=str(file))
+        box.release_file(str(file))
+        self.assertTrue(file.exists())
+        box.start()
+        await self.drained(box)
+        self.assertFalse(file.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
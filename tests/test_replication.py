@@ -0,0 +1,178 @@
+import asyncio
+import io
+import json
+import os
+import pathlib
+from unittest import mock
+
+from geobot import bot
+from geobot import geoguesser
+from geobot import lockfile
+from geobot import replication
+
+from .test_engine import TempDataTestCase
+
+
+async def no_deliver(item, message_id):
+    raise ConnectionError()
+
+
+def as_json(geo: geoguesser.Geoguesser) -> dict:
+    return json.loads(json.dumps(geo.as_ser()))
+
+
+class TestReplication(TempDataTestCase):
+    async def asyncSetUp(self):
+        self.standby_path = pathlib.Path(self.data_path, "standby.sock")
+        self.standby = replication.StandbyServer(grace=0.1)
+        self.serve = asyncio.create_task(self.standby.serve(self.standby_path))
+        self.addAsyncCleanup(self._stop_standby)
+        for _ in range(100):
+            if self.standby_path.exists():
+                break
+            await asyncio.sleep(0.01)
+
+        self.geo = geoguesser.Geoguesser(None, deliver=no_deliver)
+        await self.geo.new_trip("trip-1", 7)
+        self.tags = [await self.new_image(i, i) for i in range(3)]
+        self.geo.close_image(7, self.tags[0])
+
+        self.sent: list[dict] = []
+        self.replicator = replication.Replicator(self.geo, self.standby_path)
+        send = self.replicator._send
+
+        async def record(message: dict):
+            self.sent.append(message)
+            await send(message)
+
+        self.replicator._send = record  # type: ignore[method-assign]
+        self.replicator.start()
+        await self.caught_up()
+
+    async def _stop_standby(self):
+        await self.replicator.stop()
+        if not self.serve.done():
+            self.serve.cancel()
+        self.standby.active.release()
+
+    async def new_image(self, lat: float, long: float) -> str:
+        return await self.geo.new_image(7, io.BytesIO(b"x"), "png", lat, long, None)
+
+    async def caught_up(self):
+        for _ in range(200):
+            if (
+                self.replicator.connected
+                and self.replicator.acked == self.replicator.published > 0
+            ):
+                return
+            await asyncio.sleep(0.01)
+        self.fail("The standby didn't catch up")
+
+    async def test_snapshot_then_deltas(self):
+        self.assertEqual(self.sent[0]["kind"], "snapshot")
+        self.assertEqual(as_json(self.standby.geo), as_json(self.geo))
+
+        self.geo.new_guess(
+            7, geoguesser.MessageID(channel_id=5, message_id=9), self.tags[1], 1, 2
+        )
+        self.geo.close_image(7, self.tags[1])
+        await self.new_image(40, 40)
+        self.geo.reset_scores()
+        await self.caught_up()
+
+        self.assertEqual(as_json(self.standby.geo), as_json(self.geo))
+        self.assertEqual(
+            self.standby.geo.trips["trip-1"].maxdist, self.geo.trips["trip-1"].maxdist
+        )
+
+    async def test_deltas_only_carry_changed_images(self):
+        self.sent.clear()
+        self.geo.new_guess(
+            7, geoguesser.MessageID(channel_id=5, message_id=9), self.tags[1], 1, 2
+        )
+        await self.caught_up()
+
+        [delta] = self.sent
+        self.assertEqual(delta["kind"], "delta")
+        trip = delta["trips"]["trip-1"]
+        self.assertEqual(list(trip), ["open"])
+        self.assertEqual(list(trip["open"]), [self.tags[1]])
+
+    async def test_takes_over_when_primary_goes_away(self):
+        await self.replicator.stop()
+        geo = await asyncio.wait_for(self.serve, 5)
+        self.assertEqual(as_json(geo), as_json(self.geo))
+        self.assertFalse(self.standby.saved_is_newer())
+
+    def saved(self) -> dict:
+        with open(geoguesser.JSON_PATH) as f:
+            return json.load(f)
+
+    async def test_saves_record_the_replicated_sequence(self):
+        self.geo.close_image(7, self.tags[1])
+        await self.caught_up()
+        self.assertEqual(
+            self.saved()["replication"],
+            {"epoch": self.replicator.epoch, "seq": self.standby.seq},
+        )
+        self.assertFalse(self.standby.saved_is_newer())
+
+    # The primary saves before replicating, so it can die with changes only on
+    # disk
+    async def test_takes_over_with_newer_saved_state(self):
+        async def lost(message: dict):
+            await asyncio.Event().wait()
+
+        self.replicator._send = lost  # type: ignore[method-assign]
+        self.geo.new_guess(
+            7, geoguesser.MessageID(channel_id=5, message_id=9), self.tags[1], 1, 2
+        )
+        await self.new_image(50, 50)
+        await asyncio.sleep(0.05)
+        await self.replicator.stop()
+        geo = await asyncio.wait_for(self.serve, 5)
+
+        self.assertNotEqual(as_json(geo), as_json(self.geo))
+        self.assertTrue(self.standby.saved_is_newer())
+        geo.load()
+        self.assertEqual(as_json(geo), as_json(self.geo))
+
+    async def test_state_saved_by_another_primary_is_newer(self):
+        self.replicator.epoch = "restarted"
+        self.geo.save()
+        self.assertTrue(self.standby.saved_is_newer())
+
+    async def test_waits_for_the_primary_to_release_the_active_lock(self):
+        # Stands in for a primary that's alive but lost its connection
+        primary = lockfile.LockFile(replication.ACTIVE_LOCK_PATH)
+        self.assertTrue(primary.acquire())
+        self.addCleanup(primary.release)
+        await self.replicator.stop()
+        await asyncio.sleep(0.5)
+        self.assertFalse(self.serve.done())
+
+        primary.release()
+        geo = await asyncio.wait_for(self.serve, 5)
+        self.assertTrue(self.standby.active.held)
+        self.assertFalse(primary.acquire())
+        self.assertEqual(as_json(geo), as_json(self.geo))
+
+
+class TestStartWhileActive(TempDataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.primary = lockfile.LockFile(replication.ACTIVE_LOCK_PATH)
+        self.assertTrue(self.primary.acquire())
+        self.addCleanup(self.primary.release)
+
+    def test_refuses_to_start_without_replication(self):
+        with mock.patch.dict(os.environ, {"GEOBOT_REPLICATE": ""}):
+            with self.assertRaises(SystemExit) as cm:
+                bot.start()
+        self.assertIn(str(os.getpid()), str(cm.exception.code))
+
+    def test_runs_as_standby_with_replication(self):
+        with mock.patch.dict(os.environ, {"GEOBOT_REPLICATE": "1"}):
+            with mock.patch("geobot.replication.run_standby") as run_standby:
+                bot.start()
+        run_standby.assert_called_once()
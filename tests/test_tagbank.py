@@ -0,0 +1,107 @@
+import pathlib
+import tempfile
+import unittest
+
+from geobot import error
+from geobot import tagbank
+
+
+class TestWordList(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = pathlib.Path(tmp.name)
+
+    def word_file(self, content: str) -> pathlib.Path:
+        path = pathlib.Path(self.dir, "words.txt")
+        path.write_text(content)
+        return path
+
+    def test_lookup(self):
+        words = tagbank.WordList(self.word_file("apple\nbanana\n\ncherry"))
+        self.assertEqual(len(words), 3)
+        self.assertEqual([words[i] for i in range(3)], ["apple", "banana", "cherry"])
+        self.assertEqual(words.index("banana"), 1)
+        self.assertEqual(words.index("cherry"), 2)
+        self.assertIsNone(words.index("apricot"))
+        self.assertIsNone(words.index("zebra"))
+
+    def test_rejects_unsorted_words(self):
+        with self.assertRaises(ValueError):
+            tagbank.WordList(self.word_file("banana\napple\n"))
+
+    def test_rejects_duplicate_words(self):
+        with self.assertRaises(ValueError):
+            tagbank.WordList(self.word_file("apple\napple\n"))
+
+
+class TestTagBank(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = pathlib.Path(tmp.name, "words.txt")
+        path.write_text("\n".join(["ant", "bee", "cat", "dog", "eel"]))
+        self.bank = tagbank.TagBank(path)
+
+    def test_every_tag_round_trips(self):
+        for trip in ["", "norway"]:
+            tags = [self.bank.get_tag(trip, i) for i in range(len(self.bank))]
+            self.assertEqual(len(set(tags)), len(tags))
+            self.assertEqual(
+                [self.bank.get_index(trip, tag) for tag in tags],
+                list(range(len(self.bank))),
+            )
+
+    def test_tier_boundaries(self):
+        n = 5
+        self.assertEqual(len(self.bank), n + n**2 + n**3)
+        for index, words in [
+            (0, 1),
+            (n - 1, 1),
+            (n, 2),
+            (n + n**2 - 1, 2),
+            (n + n**2, 3),
+            (len(self.bank) - 1, 3),
+        ]:
+            tag = self.bank.get_tag("trip", index)
+            self.assertEqual(len(tag.split(tagbank.SEPARATOR)), words, index)
+        with self.assertRaises(error.TagSelectFailure):
+            self.bank.get_tag("trip", len(self.bank))
+
+    def test_trips_get_different_orders(self):
+        a = [self.bank.get_tag("a", i) for i in range(5, 30)]
+        b = [self.bank.get_tag("b", i) for i in range(5, 30)]
+        self.assertNotEqual(a, b)
+        self.assertEqual(sorted(a), sorted(b))
+
+    def test_non_tags(self):
+        self.assertIsNone(self.bank.get_index("trip", "ant-fox"))
+        self.assertIsNone(self.bank.get_index("trip", "ant-bee-cat-dog"))
+        self.assertIsNone(self.bank.get_index("trip", ""))
+        self.assertTrue(self.bank.is_tag("eel-ant"))
+        self.assertFalse(self.bank.is_tag("fox"))
+
+    # Sizes that aren't perfect squares need cycle walking to stay in range
+    def test_permutations(self):
+        key = tagbank._trip_key("trip")
+        for size in [1, 2, 3, 7, 10, 26, 101]:
+            permuted = [tagbank._permute(key, size, x) for x in range(size)]
+            self.assertEqual(sorted(permuted), list(range(size)), size)
+            self.assertEqual(
+                [tagbank._unpermute(key, size, y) for y in permuted],
+                list(range(size)),
+            )
+
+
+class TestBundledWords(unittest.TestCase):
+    def test_first_tags_round_trip(self):
+        bank = tagbank.TagBank()
+        tags = [bank.get_tag("trip", i) for i in range(5000)]
+        self.assertEqual(len(set(tags)), len(tags))
+        self.assertEqual(
+            [bank.get_index("trip", tag) for tag in tags], list(range(5000))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()